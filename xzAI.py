@@ -5,14 +5,42 @@ import win32api
 import win32con
 import time
 from chatterbot import ChatBot
-from chatterbot.trainers import ChatterBotCorpusTrainer, ListTrainer
+from chatterbot.trainers import ListTrainer
+from chatterbot.corpus import load_corpus, list_corpus_files
+from chatterbot.conversation import Statement
+from chatterbot.logic import BestMatch, MathematicalEvaluation, TimeLogicAdapter
+from chatterbot import filters
+from sqlalchemy import create_engine, text as sql_text
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
 import threading
 import os
-import sys
 import ctypes
 import json
+import re
+import shutil
+import sqlite3
+import zipfile
+import hashlib
+import mmap
+import pickle
+import struct
+import zlib
+import random
+import unicodedata
 import difflib
-from chatterbot.response_selection import get_most_frequent_response
+import heapq
+import itertools
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+try:
+    import numpy as np
+    from scipy import sparse
+except ImportError:
+    # 批量匹配引擎为可选功能，缺少依赖时退回逐条评分
+    np = None
+    sparse = None
+from chatterbot.response_selection import get_first_response
 from chatterbot.comparisons import LevenshteinDistance
 
 class ThemeTransition:
@@ -85,55 +113,2251 @@ class ThemeTransition:
             self.animation_window.destroy()
         self.active = False
 
+def extract_qa_pair(item):
+    """从训练条目中提取(规范化问题, 答案)，不支持的格式返回None"""
+    if not isinstance(item, dict):
+        return None
+    # 支持多种数据格式
+    if "question" in item and "answer" in item:
+        question = item.get("question", "")
+        answer = item.get("answer", "")
+        if isinstance(answer, list):
+            answer = answer[0] if answer else ""
+    elif "input" in item and ("target" in item or "answer" in item):
+        question = item.get("input", "")
+        answer = item.get("target", item.get("answer", ""))
+    else:
+        return None
+    # 字段类型不对的条目(如数字问题)同样视为不支持
+    if not isinstance(question, str) or not isinstance(answer, str):
+        return None
+    question = question.strip().lower()
+    if question and answer:
+        return question, answer
+    return None
+
+SENTENCE_END_PUNCTUATION = "？！。?!.~～，,"
+
+def is_emoji_char(char):
+    """判断字符是否属于表情符号：表情本身及组合用的肤色修饰符、零宽连接符、变体选择符和旗帜标签"""
+    if "\U0001f000" <= char <= "\U0001faff" or "\U000e0020" <= char <= "\U000e007f":
+        return True
+    if char in "\u200d\u20e3" or "\ufe00" <= char <= "\ufe0f":
+        return True
+    # 杂项符号和装饰符号区中的☀、✨等表情
+    return ("\u2600" <= char <= "\u27bf" or "\u2b00" <= char <= "\u2bff") and unicodedata.category(char) == "So"
+
+def canonicalize_question(text):
+    """把问题规范化为统一形式：全角转半角、去表情、去句末标点、合并空白
+    
+    #、%、^等符号和句首标点都保留，"c#"与"c"、"100%"与"100"不会被当作同一个问题
+    """
+    text = unicodedata.normalize("NFKC", text).lower()
+    text = " ".join("".join(char for char in text if not is_emoji_char(char)).split())
+    return text.rstrip(SENTENCE_END_PUNCTUATION + " ")
+
+def similarity_length_bounds(length, cutoff):
+    """根据相似度阈值计算候选问题可能的长度范围"""
+    # difflib的ratio = 2*M/(la+lb)，长度相差过大的问题不可能达到阈值
+    min_length = int(length * cutoff / (2 - cutoff))
+    max_length = int(length * (2 - cutoff) / cutoff) + 1
+    return min_length, max_length
+
+class NgramIndex:
+    """问题的字符n-gram倒排索引，在模糊匹配前快速筛选候选问题"""
+    def __init__(self, gram_sizes=(2, 3), short_length=2):
+        self.gram_sizes = gram_sizes
+        self.short_length = short_length
+        self.postings = {}
+        self.short_keys = set()
+        self.keys = set()
+
+    def grams(self, text):
+        """提取文本的字符n-gram集合"""
+        result = set()
+        for size in self.gram_sizes:
+            for i in range(len(text) - size + 1):
+                result.add(text[i:i + size])
+        return result
+
+    def add(self, key):
+        """添加问题到索引"""
+        if key in self.keys:
+            return
+        self.keys.add(key)
+        # 短问题改动一个字就可能与查询没有任何相同的n-gram，短查询时直接参与评分
+        if len(key) <= self.short_length * 2:
+            self.short_keys.add(key)
+        for gram in self.grams(key):
+            self.postings.setdefault(gram, set()).add(key)
+
+    def remove(self, key):
+        """从索引中移除问题"""
+        if key not in self.keys:
+            return
+        self.keys.discard(key)
+        self.short_keys.discard(key)
+        for gram in self.grams(key):
+            bucket = self.postings.get(gram)
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del self.postings[gram]
+
+    def clear(self):
+        """清空索引"""
+        self.postings = {}
+        self.short_keys = set()
+        self.keys = set()
+
+    def export_state(self):
+        """导出索引内容(仅包含内置类型，便于持久化)"""
+        return {
+            "gram_sizes": tuple(self.gram_sizes),
+            "short_length": self.short_length,
+            "short_key_length": self.short_length * 2,
+            "postings": self.postings,
+            "short_keys": self.short_keys,
+            "keys": self.keys
+        }
+
+    def load_state(self, state):
+        """从导出的内容恢复索引，参数不一致时返回False"""
+        if tuple(state["gram_sizes"]) != tuple(self.gram_sizes) or state["short_length"] != self.short_length:
+            return False
+        # 短问题范围不同的旧索引需要重建
+        if state.get("short_key_length") != self.short_length * 2:
+            return False
+        self.postings = state["postings"]
+        self.short_keys = state["short_keys"]
+        self.keys = state["keys"]
+        return True
+
+    def gram_count(self, length):
+        """长度为length的文本最多包含的n-gram数量"""
+        return sum(max(0, length - size + 1) for size in self.gram_sizes)
+
+    def candidates(self, query, limit=40, cutoff=0.6):
+        """返回与查询n-gram重合度(Dice系数)最高的候选问题"""
+        min_length, max_length = similarity_length_bounds(len(query), cutoff)
+        query_grams = self.grams(query)
+        scores = {}
+        for gram in query_grams:
+            for key in self.postings.get(gram, ()):
+                scores[key] = scores.get(key, 0) + 1
+        
+        # 按重合比例而不是重合个数排序，避免较长的问题挤掉更接近的候选
+        query_count = len(query_grams)
+        shortlist = heapq.nlargest(
+            limit,
+            (key for key in scores if min_length <= len(key) <= max_length),
+            key=lambda key: scores[key] / (query_count + self.gram_count(len(key)))
+        )
+        
+        # 过短的查询可能与相近的问题没有相同的n-gram，短问题直接参与评分
+        if len(query) <= self.short_length * 2:
+            seen = set(shortlist)
+            for key in self.short_keys:
+                if key not in seen and min_length <= len(key) <= max_length:
+                    shortlist.append(key)
+        return shortlist
+
+class ShingleIndex(NgramIndex):
+    """长文本(提示词类训练数据)的分片哈希索引"""
+    def __init__(self, shingle_size=4):
+        super().__init__(gram_sizes=(shingle_size,), short_length=0)
+
+    def grams(self, text):
+        """提取文本分片的CRC32哈希集合"""
+        size = self.gram_sizes[0]
+        return {zlib.crc32(text[i:i + size].encode("utf-8")) for i in range(len(text) - size + 1)}
+
+class TfidfMatcher:
+    """基于字符n-gram TF-IDF稀疏矩阵的批量问题匹配(需要numpy和scipy)"""
+    def __init__(self, gram_sizes=(1, 2, 3), chunk_size=64):
+        self.gram_sizes = gram_sizes
+        self.chunk_size = chunk_size
+        self.questions = []
+        self.vocabulary = {}
+        self.idf = None
+        self.matrix_t = None
+
+    def gram_counts(self, text, grow=False):
+        """统计文本中各n-gram在词表中的出现次数"""
+        counts = {}
+        for size in self.gram_sizes:
+            for i in range(len(text) - size + 1):
+                gram = text[i:i + size]
+                column = self.vocabulary.get(gram)
+                if column is None:
+                    if not grow:
+                        continue
+                    column = self.vocabulary[gram] = len(self.vocabulary)
+                counts[column] = counts.get(column, 0) + 1
+        return counts
+
+    def to_matrix(self, texts, grow=False):
+        """把文本列表转换为稀疏计数矩阵"""
+        indptr = [0]
+        indices = []
+        values = []
+        for text in texts:
+            counts = self.gram_counts(text, grow)
+            indices.extend(counts.keys())
+            values.extend(counts.values())
+            indptr.append(len(indices))
+        return indptr, indices, values
+
+    def weight(self, indptr, indices, values):
+        """计算TF-IDF权重并按行做L2归一化"""
+        matrix = sparse.csr_matrix(
+            (np.asarray(values, dtype=np.float32), np.asarray(indices, dtype=np.int64), np.asarray(indptr, dtype=np.int64)),
+            shape=(len(indptr) - 1, len(self.vocabulary))
+        )
+        matrix = matrix.multiply(self.idf).tocsr()
+        norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+        norms[norms == 0] = 1
+        return sparse.diags(1 / norms) @ matrix
+
+    def build(self, questions):
+        """为全部问题构建TF-IDF矩阵"""
+        self.questions = list(questions)
+        self.vocabulary = {}
+        indptr, indices, values = self.to_matrix(self.questions, grow=True)
+        document_frequency = np.bincount(np.asarray(indices, dtype=np.int64), minlength=len(self.vocabulary))
+        self.idf = (np.log((1 + len(self.questions)) / (1 + document_frequency)) + 1).astype(np.float32)
+        self.matrix_t = self.weight(indptr, indices, values).T.tocsr()
+
+    def find_similar_questions(self, batch, k=5):
+        """批量查询，每个问题返回得分最高的k个(问题, 得分)"""
+        results = []
+        for start in range(0, len(batch), self.chunk_size):
+            chunk = self.weight(*self.to_matrix(batch[start:start + self.chunk_size]))
+            # 一次稀疏矩阵乘法得到整批查询对全部问题的余弦相似度
+            scores = (chunk @ self.matrix_t).tocsr()
+            for row in range(scores.shape[0]):
+                begin, end = scores.indptr[row], scores.indptr[row + 1]
+                data = scores.data[begin:end]
+                columns = scores.indices[begin:end]
+                if len(data) > k:
+                    top = np.argpartition(-data, k - 1)[:k]
+                else:
+                    top = np.arange(len(data))
+                top = top[np.argsort(-data[top])]
+                results.append([(self.questions[columns[i]], min(float(data[i]), 1.0)) for i in top])
+        return results
+
+class ResponseCache:
+    """带容量和过期时间限制的LRU回复缓存"""
+    def __init__(self, max_size=512, ttl=600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(message, model):
+        """以小写并合并空白后的消息和当前模型作为缓存键"""
+        # 不能用canonicalize_question：它会去掉表情和句末标点，API模型对"好的？"和"好的！"的回答并不相同
+        return " ".join(message.lower().split()), model
+
+    def get(self, key):
+        """读取缓存，未命中或已过期时返回None"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] < time.monotonic():
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, response):
+        """写入缓存并淘汰最久未使用的条目"""
+        with self.lock:
+            self.entries[key] = (response, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        """清空缓存(训练数据变化时调用)"""
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """返回命中统计"""
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0
+            }
+
+def bounded_levenshtein(a, b, max_distance):
+    """计算编辑距离，一旦超过上限立即返回max_distance+1"""
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    if len(a) > len(b):
+        a, b = b, a
+    previous = list(range(len(a) + 1))
+    for i, char_b in enumerate(b, 1):
+        current = [i]
+        row_min = i
+        for j, char_a in enumerate(a, 1):
+            value = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b))
+            current.append(value)
+            if value < row_min:
+                row_min = value
+        # 整行都已超过上限，后续只会更大
+        if row_min > max_distance:
+            return max_distance + 1
+        previous = current
+    return min(previous[-1], max_distance + 1)
+
+class BKTree:
+    """基于编辑距离的BK树，适合短对话问题的模糊查找"""
+    def __init__(self, max_key_length=32):
+        self.max_key_length = max_key_length
+        self.root = None
+        self.keys = set()
+
+    def add(self, key):
+        """插入问题，过长的问题不进入BK树"""
+        if len(key) > self.max_key_length or key in self.keys:
+            return
+        self.keys.add(key)
+        if self.root is None:
+            self.root = (key, {})
+            return
+        node = self.root
+        while True:
+            distance = bounded_levenshtein(key, node[0], max(len(key), len(node[0])))
+            if distance == 0:
+                return
+            child = node[1].get(distance)
+            if child is None:
+                node[1][distance] = (key, {})
+                return
+            node = child
+
+    def remove(self, key):
+        """移除问题(节点保留用于路由，只是不再作为结果返回)"""
+        self.keys.discard(key)
+
+    def search(self, query, max_distance):
+        """返回编辑距离不超过max_distance的(距离, 问题)列表"""
+        results = []
+        if self.root is None:
+            return results
+        stack = [self.root]
+        while stack:
+            key, children = stack.pop()
+            # 只需精确到能判断子树范围的距离，更远的直接剪枝
+            bound = max_distance + (max(children) if children else 0)
+            distance = bounded_levenshtein(query, key, bound)
+            if distance <= max_distance and key in self.keys:
+                results.append((distance, key))
+            for edge, child in children.items():
+                if distance - max_distance <= edge <= distance + max_distance:
+                    stack.append(child)
+        results.sort()
+        return results
+
+    def scored(self, query, cutoff=0.6, max_distance=2):
+        """返回相似度达到阈值的(相似度, 问题)列表，相似度定义为1-距离/较长文本长度"""
+        # 搜索半径过大时BK树几乎无法剪枝，因此同时受max_distance限制
+        max_distance = min(max_distance, int(len(query) * (1 - cutoff) / cutoff))
+        results = []
+        for distance, key in self.search(query, max_distance):
+            similarity = 1 - distance / max(len(query), len(key))
+            if similarity >= cutoff:
+                results.append((similarity, key))
+        return results
+
+    def find(self, query, cutoff=0.6, max_distance=2):
+        """查找最接近的问题"""
+        results = self.scored(query, cutoff, max_distance)
+        return max(results)[1] if results else None
+
+INDEX_SIDECAR_MAGIC = b"XZIDX\x00"
+INDEX_SIDECAR_VERSION = 3
+INDEX_SIDECAR_HEADER_SIZE = 256
+LONG_QUESTION_LENGTH = 64
+
+def file_sha1(path):
+    """分块计算文件的SHA1"""
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def index_sidecar_header(stat, sha1, header_size=INDEX_SIDECAR_HEADER_SIZE):
+    """源文件的大小、修改时间和哈希，用空格补齐到固定长度以便原地更新"""
+    return json.dumps({
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "sha1": sha1
+    }).encode("utf-8").ljust(header_size)
+
+def write_index_sidecar(sidecar_path, source_path, payload):
+    """把规范化问题表和匹配索引写入带版本号的二进制旁路文件"""
+    header = index_sidecar_header(os.stat(source_path), file_sha1(source_path))
+    body = pickle.dumps(payload, protocol=pickle.HIGHEST_PROTOCOL)
+    temp_path = sidecar_path + ".tmp"
+    with open(temp_path, "wb") as f:
+        f.write(INDEX_SIDECAR_MAGIC)
+        f.write(struct.pack("<HI", INDEX_SIDECAR_VERSION, len(header)))
+        f.write(header)
+        f.write(body)
+    # 原子替换，避免中途退出留下半个索引文件
+    os.replace(temp_path, sidecar_path)
+
+def read_index_sidecar(sidecar_path, source_path):
+    """以mmap方式读取旁路索引，版本或源文件不匹配时返回None"""
+    if not os.path.exists(sidecar_path) or not os.path.exists(source_path):
+        return None
+    prefix_size = len(INDEX_SIDECAR_MAGIC) + struct.calcsize("<HI")
+    with open(sidecar_path, "rb") as f:
+        if os.fstat(f.fileno()).st_size < prefix_size:
+            return None
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if mapped[:len(INDEX_SIDECAR_MAGIC)] != INDEX_SIDECAR_MAGIC:
+                return None
+            version, header_size = struct.unpack_from("<HI", mapped, len(INDEX_SIDECAR_MAGIC))
+            if version != INDEX_SIDECAR_VERSION:
+                return None
+            header = json.loads(mapped[prefix_size:prefix_size + header_size].decode("utf-8"))
+            
+            stat = os.stat(source_path)
+            if stat.st_size != header["size"]:
+                return None
+            # 修改时间变化但内容未变(例如复制文件)时用哈希确认
+            touched = stat.st_mtime_ns != header["mtime_ns"]
+            if touched and file_sha1(source_path) != header["sha1"]:
+                return None
+            
+            with memoryview(mapped) as view, view[prefix_size + header_size:] as body:
+                payload = pickle.loads(body)
+    if touched:
+        # 记下新的修改时间，下次启动不必再对大文件计算哈希
+        refreshed = index_sidecar_header(stat, header["sha1"], header_size)
+        if len(refreshed) == header_size:
+            try:
+                with open(sidecar_path, "r+b") as f:
+                    f.seek(prefix_size)
+                    f.write(refreshed)
+            except OSError as e:
+                print(f"更新索引缓存时间戳失败: {e}")
+    return payload
+
+class MinHashLSH:
+    """基于MinHash签名和LSH分桶的近似重复问题检测"""
+    PRIME = (1 << 31) - 1
+
+    def __init__(self, num_perm=64, bands=16, threshold=0.8, shingle_size=3, seed=1):
+        rng = random.Random(seed)
+        self.coefficients = [(rng.randrange(1, self.PRIME), rng.randrange(0, self.PRIME)) for _ in range(num_perm)]
+        if np is not None:
+            self.coefficients_a = np.array([a for a, _ in self.coefficients], dtype=np.uint64)
+            self.coefficients_b = np.array([b for _, b in self.coefficients], dtype=np.uint64)
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+        self.buckets = [{} for _ in range(bands)]
+        self.signatures = {}
+
+    def signature(self, text):
+        """计算规范化文本字符分片的MinHash签名"""
+        text = canonicalize_question(text)
+        size = self.shingle_size
+        if len(text) <= size:
+            hashes = [zlib.crc32(text.encode("utf-8"))]
+        else:
+            hashes = list({zlib.crc32(text[i:i + size].encode("utf-8")) for i in range(len(text) - size + 1)})
+        if np is not None:
+            values = np.array(hashes, dtype=np.uint64)
+            mixed = (np.outer(self.coefficients_a, values) + self.coefficients_b[:, None]) % self.PRIME
+            return tuple(mixed.min(axis=1).tolist())
+        return tuple(min((a * h + b) % self.PRIME for h in hashes) for a, b in self.coefficients)
+
+    def band_keys(self, signature):
+        """把签名切分成若干段作为分桶键"""
+        for band in range(self.bands):
+            yield band, signature[band * self.rows:(band + 1) * self.rows]
+
+    def add(self, key, signature=None):
+        """加入一个问题"""
+        if key in self.signatures:
+            return
+        if signature is None:
+            signature = self.signature(key)
+        self.signatures[key] = signature
+        for band, band_key in self.band_keys(signature):
+            self.buckets[band].setdefault(band_key, []).append(key)
+
+    def remove(self, key):
+        """移除一个问题"""
+        signature = self.signatures.pop(key, None)
+        if signature is None:
+            return
+        for band, band_key in self.band_keys(signature):
+            bucket = self.buckets[band].get(band_key)
+            if bucket and key in bucket:
+                bucket.remove(key)
+                if not bucket:
+                    del self.buckets[band][band_key]
+
+    def query(self, text, signature=None):
+        """返回估计Jaccard相似度达到阈值的已有问题列表，按相似度降序"""
+        if signature is None:
+            signature = self.signature(text)
+        candidates = set()
+        for band, band_key in self.band_keys(signature):
+            candidates.update(self.buckets[band].get(band_key, ()))
+        results = []
+        for key in candidates:
+            other = self.signatures[key]
+            similarity = sum(1 for x, y in zip(signature, other) if x == y) / len(signature)
+            if similarity >= self.threshold:
+                results.append((similarity, key))
+        results.sort(reverse=True)
+        return [key for _, key in results]
+
+CHATBOT_DB_PATH = "win11_chatbot_db.sqlite3"
+
+CHATBOT_DB_PRAGMAS = [
+    ("journal_mode", "WAL"),
+    ("synchronous", "NORMAL"),
+    ("cache_size", -32000),
+    ("mmap_size", 268435456),
+    ("temp_store", "MEMORY"),
+    ("busy_timeout", 30000)
+]
+CHATBOT_DB_POOL_SIZE = 4
+
+def connect_chatbot_db(db_path=CHATBOT_DB_PATH, **kwargs):
+    """打开ChatterBot数据库连接，启用WAL并应用缓存、内存映射等参数"""
+    kwargs.setdefault("timeout", 30)
+    kwargs.setdefault("check_same_thread", False)
+    connection = sqlite3.connect(db_path, **kwargs)
+    for name, value in CHATBOT_DB_PRAGMAS:
+        connection.execute(f"PRAGMA {name}={value}")
+    return connection
+
+def create_chatbot_engine(db_path=CHATBOT_DB_PATH, pool_size=CHATBOT_DB_POOL_SIZE):
+    """创建带有限连接池的数据库引擎，读请求不必等待训练写入"""
+    return create_engine(
+        f"sqlite:///{db_path}",
+        creator=lambda: connect_chatbot_db(db_path),
+        poolclass=QueuePool,
+        pool_size=pool_size,
+        max_overflow=0,
+        pool_timeout=30,
+        convert_unicode=True
+    )
+
+class BulkTrainer:
+    """批量训练器：按ListTrainer的规则预处理语句，在单个事务中用executemany写入ChatterBot数据库"""
+    STATEMENT_INDEXES = [
+        ("ix_statement_search_in_response_to", "search_in_response_to"),
+        ("ix_statement_in_response_to", "in_response_to"),
+        ("ix_statement_text", "text")
+    ]
+    CHECKPOINT_TABLE_SQL = (
+        "CREATE TABLE IF NOT EXISTS training_checkpoint ("
+        "source VARCHAR(255) PRIMARY KEY, position INTEGER NOT NULL, total INTEGER NOT NULL)"
+    )
+    # 首次训练标记：创建数据库时写入，全部来源训练完成后才置为完成
+    FIRST_RUN_SOURCE = "__first_run__"
+    INSERT_SQL = (
+        "INSERT INTO statement (text, search_text, conversation, created_at, "
+        "in_response_to, search_in_response_to, persona) VALUES (?, ?, ?, ?, ?, ?, ?)"
+    )
+
+    def __init__(self, chatbot, db_path=CHATBOT_DB_PATH, batch_size=1000,
+                 defer_index_threshold=5000, progress_callback=None):
+        self.chatbot = chatbot
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.defer_index_threshold = defer_index_threshold
+        self.progress_callback = progress_callback
+        self.committed = 0
+        self.tagger = chatbot.storage.tagger
+        self.preprocess = ListTrainer(chatbot).get_preprocessed_statement
+
+    def statement_rows(self, conversation):
+        """把一段对话转换为statement表的行，与ListTrainer.train写入的内容一致"""
+        rows = []
+        previous_text = None
+        previous_search_text = ""
+        for text in conversation:
+            search_text = self.tagger.get_bigram_pair_string(text)
+            statement = self.preprocess(Statement(
+                text=text,
+                search_text=search_text,
+                in_response_to=previous_text,
+                search_in_response_to=previous_search_text,
+                conversation="training"
+            ))
+            rows.append((
+                statement.text,
+                statement.search_text,
+                statement.conversation,
+                statement.created_at.strftime("%Y-%m-%d %H:%M:%S.%f"),
+                statement.in_response_to,
+                statement.search_in_response_to,
+                statement.persona
+            ))
+            previous_text = statement.text
+            previous_search_text = search_text
+        return rows
+
+    @classmethod
+    def drop_indexes(cls, connection):
+        """删除辅助索引，大批量写入结束后再统一重建"""
+        for name, _ in cls.STATEMENT_INDEXES:
+            connection.execute(f"DROP INDEX IF EXISTS {name}")
+
+    @classmethod
+    def create_indexes(cls, connection):
+        """创建辅助索引，加速按回复关系查找语句"""
+        for name, column in cls.STATEMENT_INDEXES:
+            connection.execute(f"CREATE INDEX IF NOT EXISTS {name} ON statement ({column})")
+
+    def save_checkpoint(self, connection, source, position):
+        """记录来源已提交的对话数"""
+        connection.execute(
+            "UPDATE training_checkpoint SET position = ? WHERE source = ?", (position, source)
+        )
+
+    def report(self, done, total):
+        """报告训练进度"""
+        if self.progress_callback:
+            self.progress_callback(done, total)
+        else:
+            print(f"批量训练进度: {done}/{total if total is not None else '?'}")
+
+    def write(self, connection, rows, tags=()):
+        """写入一批语句，并为每条语句关联标签"""
+        if tags:
+            # 写事务期间没有其他写入者，新语句的id从当前最大id之后连续分配
+            first_id = connection.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM statement").fetchone()[0]
+        connection.executemany(self.INSERT_SQL, rows)
+        if tags:
+            connection.executemany("INSERT OR IGNORE INTO tag (name) VALUES (?)", [(tag,) for tag in tags])
+            tag_ids = [
+                connection.execute("SELECT id FROM tag WHERE name = ?", (tag,)).fetchone()[0]
+                for tag in tags
+            ]
+            connection.executemany(
+                "INSERT INTO tag_association (tag_id, statement_id) VALUES (?, ?)",
+                [(tag_id, statement_id) for statement_id in range(first_id, first_id + len(rows)) for tag_id in tag_ids]
+            )
+
+    def register_sources(self, sources):
+        """登记分来源训练的各个来源及其对话总数，已登记的来源保留原有检查点"""
+        connection = connect_chatbot_db(self.db_path)
+        try:
+            with connection:
+                connection.execute(self.CHECKPOINT_TABLE_SQL)
+                connection.executemany(
+                    "INSERT OR IGNORE INTO training_checkpoint (source, position, total) VALUES (?, 0, ?)",
+                    sources
+                )
+        finally:
+            connection.close()
+
+    def pending_sources(self):
+        """返回尚未训练完成的来源：{来源: (已提交的对话数, 对话总数)}"""
+        connection = connect_chatbot_db(self.db_path)
+        try:
+            connection.execute(self.CHECKPOINT_TABLE_SQL)
+            rows = connection.execute(
+                "SELECT source, position, total FROM training_checkpoint WHERE position < total AND source != ?",
+                (self.FIRST_RUN_SOURCE,)
+            ).fetchall()
+        finally:
+            connection.close()
+        return {source: (position, total) for source, position, total in rows}
+
+    @classmethod
+    def mark_first_run(cls, db_path=CHATBOT_DB_PATH):
+        """在数据库中写入首次训练标记，应在任何耗时操作之前调用"""
+        connection = connect_chatbot_db(db_path)
+        try:
+            with connection:
+                connection.execute(cls.CHECKPOINT_TABLE_SQL)
+                connection.execute(
+                    "INSERT OR IGNORE INTO training_checkpoint (source, position, total) VALUES (?, 0, 1)",
+                    (cls.FIRST_RUN_SOURCE,)
+                )
+        finally:
+            connection.close()
+
+    @classmethod
+    def first_run_pending(cls, db_path=CHATBOT_DB_PATH):
+        """首次训练标记存在且尚未完成时返回True"""
+        connection = connect_chatbot_db(db_path)
+        try:
+            connection.execute(cls.CHECKPOINT_TABLE_SQL)
+            row = connection.execute(
+                "SELECT position < total FROM training_checkpoint WHERE source = ?", (cls.FIRST_RUN_SOURCE,)
+            ).fetchone()
+        finally:
+            connection.close()
+        return bool(row and row[0])
+
+    def finish_first_run(self):
+        """全部来源训练完成后把首次训练标记置为完成"""
+        connection = connect_chatbot_db(self.db_path)
+        try:
+            with connection:
+                connection.execute(
+                    "UPDATE training_checkpoint SET position = total WHERE source = ?", (self.FIRST_RUN_SOURCE,)
+                )
+        finally:
+            connection.close()
+
+    def checkpoint(self, connection, source):
+        """读取来源已提交的对话数"""
+        row = connection.execute(
+            "SELECT position FROM training_checkpoint WHERE source = ?", (source,)
+        ).fetchone()
+        return row[0] if row else 0
+
+    def train(self, conversations, total=None, source=None, tags=(), incremental=False):
+        """批量训练多段对话，返回本次训练的对话数
+        
+        未指定source时全部写入成功才提交；指定source时每批连同检查点一起提交，中断后再次调用会跳过已提交的部分；
+        incremental为True时每批在单独的短事务中提交，已提交的对话数记录在committed中
+        """
+        if total is None and hasattr(conversations, "__len__"):
+            total = len(conversations)
+        incremental = incremental and source is None
+        connection = connect_chatbot_db(self.db_path, isolation_level=None)
+        trained = 0
+        self.committed = 0
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            position = 0
+            if source is not None:
+                connection.execute(self.CHECKPOINT_TABLE_SQL)
+                connection.execute(
+                    "INSERT OR IGNORE INTO training_checkpoint (source, position, total) VALUES (?, 0, ?)",
+                    (source, total or 0)
+                )
+                position = self.checkpoint(connection, source)
+                if total is not None:
+                    total = max(0, total - position)
+            # 总数未知（如流式读取）时先保留索引，写入量达到阈值后再推迟重建；
+            # 逐批提交时其他连接会读到中间状态，始终保留索引
+            defer_indexes = not incremental and total is not None and total >= self.defer_index_threshold
+            if defer_indexes:
+                self.drop_indexes(connection)
+            else:
+                self.create_indexes(connection)
+            if incremental:
+                # 读取和准备对话期间不占用写锁，聊天时的写入只需等待一个批次
+                connection.execute("COMMIT")
+            rows = []
+            for conversation in itertools.islice(conversations, position, None):
+                rows.extend(self.statement_rows(conversation))
+                trained += 1
+                if not incremental and not defer_indexes and total is None and trained >= self.defer_index_threshold:
+                    self.drop_indexes(connection)
+                    defer_indexes = True
+                if trained % self.batch_size == 0:
+                    if incremental:
+                        connection.execute("BEGIN IMMEDIATE")
+                    self.write(connection, rows, tags)
+                    rows = []
+                    if source is not None:
+                        # 检查点与本批数据在同一事务中提交
+                        self.save_checkpoint(connection, source, position + trained)
+                        connection.execute("COMMIT")
+                        connection.execute("BEGIN IMMEDIATE")
+                    if incremental:
+                        connection.execute("COMMIT")
+                        self.committed = trained
+                    self.report(trained, total)
+            if incremental:
+                connection.execute("BEGIN IMMEDIATE")
+            if rows:
+                self.write(connection, rows, tags)
+            if source is not None:
+                self.save_checkpoint(connection, source, position + trained)
+            if defer_indexes:
+                self.create_indexes(connection)
+            connection.execute("COMMIT")
+            self.committed = trained
+        except Exception:
+            if connection.in_transaction:
+                connection.execute("ROLLBACK")
+            raise
+        finally:
+            connection.close()
+        self.report(trained, total)
+        return trained
+
+def upgrade_chatbot_db(db_path=CHATBOT_DB_PATH):
+    """升级ChatterBot数据库结构：为statement表增加记录合并次数的occurrences列"""
+    connection = connect_chatbot_db(db_path)
+    try:
+        columns = [row[1] for row in connection.execute("PRAGMA table_info(statement)")]
+        if "occurrences" not in columns:
+            with connection:
+                connection.execute("ALTER TABLE statement ADD COLUMN occurrences INTEGER NOT NULL DEFAULT 1")
+    finally:
+        connection.close()
+
+def chatbot_db_size(db_path=CHATBOT_DB_PATH):
+    """数据库文件及其WAL文件的总大小(字节)"""
+    return sum(os.path.getsize(path) for path in (db_path, db_path + "-wal") if os.path.exists(path))
+
+def measure_lookup_latency(connection, samples):
+    """测量按回复关系查找语句的平均耗时(毫秒)"""
+    if not samples:
+        return 0.0
+    start = time.perf_counter()
+    for search_text in samples:
+        connection.execute(
+            "SELECT id, text FROM statement WHERE search_in_response_to = ?", (search_text,)
+        ).fetchall()
+    return (time.perf_counter() - start) * 1000 / len(samples)
+
+def compact_chatbot_db(db_path=CHATBOT_DB_PATH, sample_size=200):
+    """整理ChatterBot数据库：合并重复语句并累计出现次数，删除孤立的标签记录，重建索引并VACUUM"""
+    upgrade_chatbot_db(db_path)
+    connection = connect_chatbot_db(db_path, isolation_level=None)
+    try:
+        connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        samples = [row[0] for row in connection.execute(
+            "SELECT search_text FROM statement ORDER BY RANDOM() LIMIT ?", (sample_size,)
+        )]
+        result = {
+            "size_before": chatbot_db_size(db_path),
+            "latency_before": measure_lookup_latency(connection, samples),
+            "statements_before": connection.execute("SELECT COUNT(*) FROM statement").fetchone()[0]
+        }
+        
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            # 同一对话中文本和回复关系都相同的语句视为重复，保留id最小的一条
+            connection.execute("CREATE TEMP TABLE statement_duplicate (id INTEGER PRIMARY KEY, keep_id INTEGER NOT NULL)")
+            connection.execute(
+                "INSERT INTO statement_duplicate (id, keep_id) "
+                "SELECT id, keep_id FROM ("
+                "SELECT id, MIN(id) OVER (PARTITION BY text, in_response_to, conversation, persona) AS keep_id "
+                "FROM statement) WHERE id != keep_id"
+            )
+            connection.execute("CREATE INDEX temp.ix_statement_duplicate_keep_id ON statement_duplicate (keep_id)")
+            connection.execute(
+                "UPDATE statement SET occurrences = occurrences + ("
+                "SELECT SUM(duplicate.occurrences) FROM statement AS duplicate "
+                "JOIN statement_duplicate ON duplicate.id = statement_duplicate.id "
+                "WHERE statement_duplicate.keep_id = statement.id) "
+                "WHERE id IN (SELECT keep_id FROM statement_duplicate)"
+            )
+            connection.execute(
+                "UPDATE tag_association SET statement_id = ("
+                "SELECT keep_id FROM statement_duplicate WHERE id = tag_association.statement_id) "
+                "WHERE statement_id IN (SELECT id FROM statement_duplicate)"
+            )
+            result["merged"] = connection.execute(
+                "DELETE FROM statement WHERE id IN (SELECT id FROM statement_duplicate)"
+            ).rowcount
+            
+            # 孤立的标签关联、重复的关联以及不再被使用的标签
+            orphans = connection.execute(
+                "DELETE FROM tag_association WHERE statement_id NOT IN (SELECT id FROM statement) "
+                "OR tag_id NOT IN (SELECT id FROM tag)"
+            ).rowcount
+            orphans += connection.execute(
+                "DELETE FROM tag_association WHERE rowid NOT IN ("
+                "SELECT MIN(rowid) FROM tag_association GROUP BY tag_id, statement_id)"
+            ).rowcount
+            orphans += connection.execute(
+                "DELETE FROM tag WHERE id NOT IN (SELECT tag_id FROM tag_association)"
+            ).rowcount
+            result["orphans"] = orphans
+            
+            connection.execute("DROP TABLE temp.statement_duplicate")
+            BulkTrainer.create_indexes(connection)
+            connection.execute("REINDEX")
+            connection.execute("COMMIT")
+        except Exception:
+            if connection.in_transaction:
+                connection.execute("ROLLBACK")
+            raise
+        
+        connection.execute("VACUUM")
+        connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        result["size_after"] = chatbot_db_size(db_path)
+        result["latency_after"] = measure_lookup_latency(connection, samples)
+        result["statements_after"] = connection.execute("SELECT COUNT(*) FROM statement").fetchone()[0]
+        return result
+    finally:
+        connection.close()
+
+def training_file_format(path):
+    """根据第一个非空白字符判断训练文件格式：JSON数组返回"array"，JSON Lines返回"lines"，空文件返回None"""
+    with open(path, "r", encoding="utf-8") as f:
+        while True:
+            char = f.read(1)
+            if not char:
+                return None
+            if not char.isspace():
+                return "array" if char == "[" else "lines"
+
+def find_record_end(buffer, position, indent=None):
+    """从position开始扫描一个(可能格式错误的)数组元素，返回其后顶层','或']'的位置，缓冲区内未结束时返回None
+    
+    indent为元素起始行的缩进；引号或括号不配对时在下一个同样缩进、以'{'开头的行前结束，一条坏记录不会吞掉后面的记录
+    """
+    depth = 0
+    quote = None
+    index = position
+    while index < len(buffer):
+        char = buffer[index]
+        if char == "\n" and indent is not None and (quote is not None or depth > 0):
+            line_start = index + 1
+            if line_start + indent >= len(buffer):
+                # 下一行还不完整，读入更多数据后再判断
+                return None
+            if buffer[line_start + indent] == "{" and not buffer[line_start:line_start + indent].strip(" \t"):
+                return index
+        if quote is not None:
+            if char == "\\":
+                index += 1
+            elif char == quote:
+                quote = None
+        elif char in "\"'":
+            quote = char
+        elif char in "[{":
+            depth += 1
+        elif char in "]}":
+            if depth == 0:
+                # 多余的'}'视为本条记录的一部分
+                if char == "]":
+                    return index
+            else:
+                depth -= 1
+        elif char == "," and depth == 0:
+            return index
+        index += 1
+    return None
+
+def iter_json_array(f, chunk_size=1 << 20, recovery=None):
+    """增量解析顶层JSON数组，逐个产出元素，内存中只保留当前缓冲区
+    
+    指定recovery时格式错误的元素交给recovery.repair逐条修复或隔离，其余元素照常产出
+    """
+    decoder = json.JSONDecoder()
+    whitespace = re.compile(r"\s*")
+    number_tail = re.compile(r"[0-9.eE+\-]*")
+    buffer = ""
+    position = 0
+    eof = False
+    state = "start"
+    record = 0
+    # 当前元素起始行的缩进，元素不在行首时为None
+    indent = None
+    while True:
+        gap_end = whitespace.match(buffer, position).end()
+        if gap_end > position:
+            gap = buffer[position:gap_end]
+            if "\n" in gap:
+                indent = len(gap) - gap.rfind("\n") - 1
+            elif position > 0:
+                indent = None
+            elif indent is not None:
+                # 空白跨越了缓冲区边界，接着累加同一行的缩进
+                indent += len(gap)
+        position = gap_end
+        if position >= len(buffer) or state == "need_more":
+            if eof:
+                if recovery is not None and state != "start":
+                    # 缺少结尾的']'，已读到的元素都已产出
+                    return
+                raise json.JSONDecodeError("JSON数组不完整", buffer, position)
+            # 丢弃已解析的部分；单个元素跨越多个缓冲区时读取量随缓冲区增长
+            chunk = f.read(max(chunk_size, len(buffer) - position))
+            eof = not chunk
+            buffer = buffer[position:] + chunk
+            position = 0
+            if state == "need_more":
+                state = "value"
+            continue
+        char = buffer[position]
+        if state == "start":
+            if char != "[":
+                raise json.JSONDecodeError("应为JSON数组", buffer, position)
+            position += 1
+            indent = None
+            state = "first"
+        elif state in ("first", "value"):
+            if state == "first" and char == "]":
+                return
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError as e:
+                if recovery is None:
+                    if eof:
+                        raise
+                    state = "need_more"
+                    continue
+                # 元素完整在缓冲区内仍无法解析时才算格式错误，否则读入更多数据
+                end = find_record_end(buffer, position, indent)
+                if end is None and not eof:
+                    state = "need_more"
+                    continue
+                if end is None:
+                    end = len(buffer)
+                text = buffer[position:end].strip()
+                if text:
+                    record += 1
+                    item = recovery.repair(text, e.msg, record)
+                    if item is not None:
+                        yield item
+                position = end
+                state = "separator"
+                continue
+            # 数字等元素可能恰好在缓冲区末尾被截断(如"1500."只解析出1500)，读入更多数据后重新解析
+            if not eof and (end >= len(buffer) or (
+                    isinstance(item, (int, float)) and number_tail.match(buffer, end).end() >= len(buffer))):
+                state = "need_more"
+                continue
+            record += 1
+            if recovery is not None:
+                item = recovery.check(item, buffer[position:end], record)
+            position = end
+            state = "separator"
+            if item is not None:
+                yield item
+        else:
+            if char == ",":
+                position += 1
+                indent = None
+                state = "value"
+            elif char == "]":
+                return
+            elif recovery is not None:
+                # 缺少逗号，从这里开始按下一个元素解析
+                state = "value"
+            else:
+                raise json.JSONDecodeError("应为','或']'", buffer, position)
+
+def iter_training_items(path, chunk_size=1 << 20, progress_callback=None, recovery=None):
+    """流式读取训练文件，逐条产出JSON数组或JSON Lines中的条目；progress_callback接收已读取的字节数
+    
+    指定recovery时格式错误的记录逐条修复或隔离，不影响其他记录
+    """
+    file_format = training_file_format(path)
+    if file_format is None:
+        return
+    with open(path, "r", encoding="utf-8") as f:
+        if file_format == "array":
+            for item in iter_json_array(f, chunk_size, recovery):
+                if progress_callback is not None:
+                    progress_callback(f.buffer.tell())
+                yield item
+            return
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                item = json.loads(line)
+            except json.JSONDecodeError as e:
+                if recovery is None:
+                    raise json.JSONDecodeError(f"第{line_number}行: {e.msg}", e.doc, e.pos)
+                item = recovery.repair(line, e.msg, line_number)
+                if item is None:
+                    continue
+            else:
+                if recovery is not None:
+                    item = recovery.check(item, line, line_number)
+                    if item is None:
+                        continue
+            if progress_callback is not None:
+                progress_callback(f.buffer.tell())
+            yield item
+
+PYTHON_LITERALS = {"True": "true", "False": "false", "None": "null"}
+
+def rewrite_json_tokens(text, python_syntax=False):
+    """逐字符改写字符串字面量之外的内容：去掉对象和数组末尾的多余逗号；
+    python_syntax为True时再把单引号字符串转成双引号字符串，把True/False/None转成JSON字面量。
+    字符串内容始终原样保留
+    """
+    out = []
+    i = 0
+    length = len(text)
+    while i < length:
+        ch = text[i]
+        if ch == "\"":
+            # 双引号字符串整体照抄，跳过其中的转义字符
+            j = i + 1
+            while j < length and text[j] != "\"":
+                j += 2 if text[j] == "\\" else 1
+            out.append(text[i:j + 1])
+            i = j + 1
+        elif ch == "'" and python_syntax:
+            # 单引号字符串：\'还原为单引号，内部的双引号加上转义，其余转义照抄
+            j = i + 1
+            chars = []
+            while j < length and text[j] != "'":
+                if text[j] == "\\" and j + 1 < length:
+                    chars.append("'" if text[j + 1] == "'" else text[j:j + 2])
+                    j += 2
+                    continue
+                chars.append("\\\"" if text[j] == "\"" else text[j])
+                j += 1
+            out.append("\"" + "".join(chars) + "\"")
+            i = j + 1
+        elif ch == ",":
+            j = i + 1
+            while j < length and text[j].isspace():
+                j += 1
+            if j >= length or text[j] not in "}]":
+                out.append(ch)
+            i += 1
+        elif ch.isalpha() or ch == "_":
+            j = i
+            while j < length and (text[j].isalnum() or text[j] == "_"):
+                j += 1
+            word = text[i:j]
+            out.append(PYTHON_LITERALS.get(word, word) if python_syntax else word)
+            i = j
+        else:
+            out.append(ch)
+            i += 1
+    return "".join(out)
+
+def repair_training_record(text):
+    """修复单条记录中多余逗号、单引号和Python布尔值等常见格式问题，仍无法解析时返回None
+    
+    先只去掉多余逗号，仍无法解析时再转换单引号和Python字面量，两步都不改动字符串内容
+    """
+    for python_syntax in (False, True):
+        try:
+            return json.loads(rewrite_json_tokens(text, python_syntax))
+        except json.JSONDecodeError:
+            continue
+    return None
+
+def training_item_error(item):
+    """检查训练条目的字段类型：问题和答案必须是非空字符串(answer也可以是字符串列表)，不符合时返回原因，否则返回None"""
+    if not isinstance(item, dict):
+        return "记录不是JSON对象"
+    if "question" in item and "answer" in item:
+        question = item["question"]
+        answers = item["answer"] if isinstance(item["answer"], list) else [item["answer"]]
+    elif "input" in item and ("target" in item or "answer" in item):
+        question = item["input"]
+        answers = [item.get("target", item.get("answer"))]
+    else:
+        return "缺少问题或答案字段"
+    if not isinstance(question, str) or not question.strip():
+        return "问题不是非空字符串"
+    if not all(isinstance(answer, str) for answer in answers) or not any(answer.strip() for answer in answers):
+        return "答案不是非空字符串"
+    return None
+
+class TrainingRecordRecovery:
+    """逐条修复格式错误的训练记录，无法修复的原样隔离到拒收文件，其余记录照常使用"""
+    def __init__(self, source_path, rejects_path=None):
+        self.source_path = source_path
+        # 拒收文件放在程序目录，以源文件名命名
+        self.rejects_path = rejects_path or os.path.splitext(os.path.basename(source_path))[0] + ".rejects.jsonl"
+        self.repaired = 0
+        self.rejected = 0
+        self.file = None
+
+    def repair(self, text, error, record):
+        """尝试修复一条记录，成功返回条目，失败时写入拒收文件并返回None"""
+        item = repair_training_record(text)
+        if item is None:
+            self.reject(text, error, record)
+            return None
+        item = self.check(item, text, record)
+        if item is not None:
+            self.repaired += 1
+        return item
+
+    def check(self, item, text, record):
+        """检查已解析记录的字段类型，不符合时写入拒收文件并返回None"""
+        error = training_item_error(item)
+        if error is None:
+            return item
+        self.reject(text, error, record)
+        return None
+
+    def reject(self, text, error, record):
+        """把无法修复的记录连同位置和错误原因追加到拒收文件"""
+        if self.file is None:
+            self.file = open(self.rejects_path, "a", encoding="utf-8")
+        self.file.write(json.dumps({
+            "source": self.source_path,
+            "record": record,
+            "error": error,
+            "raw": text
+        }, ensure_ascii=False) + "\n")
+        self.rejected += 1
+
+    def close(self):
+        """关闭拒收文件"""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def summary(self):
+        """修复和隔离结果的说明，没有格式错误时返回None"""
+        if not self.repaired and not self.rejected:
+            return None
+        text = f"训练文件中有 {self.repaired + self.rejected} 条记录格式错误，已修复 {self.repaired} 条"
+        if self.rejected:
+            text += f"，{self.rejected} 条无法修复，已隔离到 {self.rejects_path}"
+        return text
+
+PARSE_CHUNK_SIZE = 4 << 20
+PARSE_PARALLEL_MIN_SIZE = 16 << 20
+
+def normalize_training_item(item):
+    """把一条训练条目规范化为若干条单答案条目，不支持的格式返回空列表"""
+    if not isinstance(item, dict):
+        return []
+    # 标准问答格式，答案可以是列表
+    if "question" in item and "answer" in item:
+        question = item.get("question", "")
+        answers = item.get("answer", [])
+        if not isinstance(answers, list):
+            answers = [answers]
+        if not isinstance(question, str) or not question:
+            return []
+        return [{"question": question, "answer": answer} for answer in answers if isinstance(answer, str) and answer]
+    # 任务格式（含answer_choices的分类任务同样以input/target训练）
+    if "input" in item and ("target" in item or "answer" in item):
+        question = item.get("input", "")
+        answer = item.get("target", item.get("answer", ""))
+        if isinstance(question, str) and isinstance(answer, str) and question and answer:
+            return [{"input": question, "target": answer}]
+    return []
+
+def split_line_ranges(path, chunk_size=PARSE_CHUNK_SIZE):
+    """按行边界把文件切分为大约chunk_size字节的区间"""
+    size = os.path.getsize(path)
+    ranges = []
+    with open(path, "rb") as f:
+        start = 0
+        while start < size:
+            f.seek(min(start + chunk_size, size))
+            f.readline()
+            end = min(f.tell(), size)
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+def parse_training_chunk(path, start, end, recover=False):
+    """在子进程中解析JSON Lines文件的一个字节区间，返回(规范化条目, 行数, 错误列表, 修复数)
+    
+    recover为False时遇到第一个错误即停止；为True时逐行修复，无法修复的行记入错误列表后继续
+    """
+    with open(path, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+    entries = []
+    errors = []
+    repaired = 0
+    # 按字节换行切分，避免字符串中的U+2028等字符被当作换行
+    lines = data.split(b"\n")
+    if lines and not lines[-1]:
+        lines.pop()
+    for line_number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            text = line.decode("utf-8")
+        except UnicodeDecodeError as e:
+            errors.append((line_number, "不是有效的UTF-8编码", line.decode("utf-8", "replace"), e.start))
+            if not recover:
+                break
+            continue
+        was_repaired = False
+        try:
+            item = json.loads(text)
+        except json.JSONDecodeError as e:
+            item = repair_training_record(text) if recover else None
+            if item is None:
+                errors.append((line_number, e.msg, text, e.pos))
+                if not recover:
+                    break
+                continue
+            was_repaired = True
+        # 字段类型不对的记录与格式错误的记录一样隔离；不修复时照旧跳过
+        error = training_item_error(item)
+        if error is not None:
+            if recover:
+                errors.append((line_number, error, text, 0))
+            continue
+        if was_repaired:
+            repaired += 1
+        entries.extend(normalize_training_item(item))
+    return entries, len(lines), errors, repaired
+
+def iter_training_entries(path, workers=None, chunk_size=PARSE_CHUNK_SIZE, min_parallel_size=PARSE_PARALLEL_MIN_SIZE,
+                          progress_callback=None, recovery=None):
+    """逐条产出规范化后的训练条目：大型JSON Lines文件分块后在进程池中并行解析，按原顺序合并"""
+    if training_file_format(path) != "lines" or os.path.getsize(path) < min_parallel_size:
+        for item in iter_training_items(path, progress_callback=progress_callback, recovery=recovery):
+            yield from normalize_training_item(item)
+        return
+    workers = workers or os.cpu_count() or 1
+    ranges = iter(split_line_ranges(path, chunk_size))
+    line_offset = 0
+    executor = ProcessPoolExecutor(max_workers=workers)
+    pending = deque()
+    try:
+        # 在途分块数有上限，消费慢时结果不会全部堆积在内存中
+        for start, end in itertools.islice(ranges, workers * 2):
+            pending.append((end, executor.submit(parse_training_chunk, path, start, end, recovery is not None)))
+        while pending:
+            chunk_end, future = pending.popleft()
+            entries, line_count, errors, repaired = future.result()
+            for start, end in itertools.islice(ranges, 1):
+                pending.append((end, executor.submit(parse_training_chunk, path, start, end, recovery is not None)))
+            if errors and recovery is None:
+                line_number, message, text, position = errors[0]
+                raise json.JSONDecodeError(f"第{line_offset + line_number}行: {message}", text, position)
+            if recovery is not None:
+                # 修复在子进程中完成，拒收文件只在主进程中按顺序写入
+                recovery.repaired += repaired
+                for line_number, message, text, _ in errors:
+                    recovery.reject(text, message, line_offset + line_number)
+            line_offset += line_count
+            if progress_callback is not None:
+                progress_callback(chunk_end)
+            yield from entries
+    finally:
+        for _, future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+TRAINING_JOURNAL_PATH = "xunlian.journal.jsonl"
+
+class TrainingJournal:
+    """训练数据的追加日志：新条目逐行追加，后台压缩时连同主文件写成新的xunlian.json并原子替换"""
+    def __init__(self, base_path="xunlian.json", journal_path=TRAINING_JOURNAL_PATH, compact_threshold=500):
+        self.base_path = base_path
+        self.journal_path = journal_path
+        # 压缩开始时日志改名为rotated_path，新文件先写到compact_path
+        self.rotated_path = journal_path + ".compacting"
+        self.compact_path = base_path + ".compacting"
+        self.compact_threshold = compact_threshold
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.worker = None
+
+    def recover(self):
+        """处理上次退出时中断的追加或压缩"""
+        if os.path.exists(self.rotated_path):
+            # 轮换出的日志还在，说明新文件尚未替换主文件，丢弃半成品，日志照常重放
+            if os.path.exists(self.compact_path):
+                os.remove(self.compact_path)
+        elif os.path.exists(self.compact_path):
+            # 轮换出的日志只在新文件完整落盘后才删除，补完最后的改名
+            os.replace(self.compact_path, self.base_path)
+        for path in (self.rotated_path, self.journal_path):
+            if not os.path.exists(path):
+                continue
+            # 追加中途退出只会留下不完整的最后一行，截掉以免与下一条记录粘连
+            with open(path, "rb+") as f:
+                size = f.seek(0, os.SEEK_END)
+                if size == 0:
+                    continue
+                f.seek(size - 1)
+                if f.read(1) != b"\n":
+                    f.seek(0)
+                    f.truncate(f.read().rfind(b"\n") + 1)
+
+    def replay(self):
+        """按写入顺序逐条产出尚未合并进主文件的条目"""
+        self.pending = 0
+        for path in (self.rotated_path, self.journal_path):
+            if not os.path.exists(path):
+                continue
+            with open(path, "r", encoding="utf-8") as f:
+                for line_number, line in enumerate(f, 1):
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        item = json.loads(line)
+                    except json.JSONDecodeError as e:
+                        print(f"跳过日志 {path} 第{line_number}行: {e}")
+                        continue
+                    self.pending += 1
+                    yield item
+
+    def append(self, items):
+        """把新条目追加到日志并落盘，返回是否达到压缩阈值"""
+        lines = "".join(json.dumps(item, ensure_ascii=False) + "\n" for item in items)
+        with self.lock:
+            with open(self.journal_path, "a", encoding="utf-8") as f:
+                f.write(lines)
+                f.flush()
+                os.fsync(f.fileno())
+            self.pending += len(items)
+        return self.pending >= self.compact_threshold
+
+    def compact(self, snapshot, wait=False):
+        """轮换日志并在后台把快照写成新的主文件；已有压缩在进行时wait为False则跳过，返回是否已开始"""
+        if self.worker is not None and self.worker.is_alive():
+            if not wait:
+                return False
+            self.worker.join()
+        with self.lock:
+            if not os.path.exists(self.journal_path):
+                # 即使没有日志也留下轮换文件，recover据此判断新文件是否写完
+                open(self.rotated_path, "a").close()
+            elif os.path.exists(self.rotated_path):
+                # 上次压缩失败留下的日志尚未合并，接在其后
+                with open(self.rotated_path, "ab") as target, open(self.journal_path, "rb") as source:
+                    shutil.copyfileobj(source, target)
+                os.remove(self.journal_path)
+            else:
+                os.replace(self.journal_path, self.rotated_path)
+            self.pending = 0
+        self.worker = threading.Thread(target=self.write_base, args=(snapshot,), daemon=True)
+        self.worker.start()
+        return True
+
+    def write_base(self, snapshot):
+        """写出新的主文件，落盘后删除轮换出的日志并原子替换"""
+        try:
+            with open(self.compact_path, "w", encoding="utf-8") as f:
+                json.dump(snapshot, f, ensure_ascii=False, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            with self.lock:
+                os.remove(self.rotated_path)
+                os.replace(self.compact_path, self.base_path)
+            print(f"已保存 {len(snapshot)} 条训练数据")
+        except Exception as e:
+            print(f"压缩训练数据失败: {e}")
+
+    def wait(self):
+        """等待正在进行的压缩完成"""
+        if self.worker is not None:
+            self.worker.join()
+
+    def reset(self):
+        """主文件被整体替换后丢弃全部日志"""
+        self.wait()
+        with self.lock:
+            for path in (self.journal_path, self.rotated_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            self.pending = 0
+
+SNAPSHOT_FORMAT = "xzai-knowledge-snapshot"
+SNAPSHOT_VERSION = 2
+# 版本1的快照另带pickle格式的索引，导入时忽略，索引总是从训练数据重建
+SNAPSHOT_READABLE_VERSIONS = (1, 2)
+KNOWLEDGE_SNAPSHOT_PATH = "knowledge_snapshot.zip"
+
+def export_knowledge_snapshot(snapshot_path, training_data, db_path=CHATBOT_DB_PATH):
+    """导出知识快照：训练数据和ChatterBot数据库打包为一个zip文件，返回清单"""
+    db_copy = snapshot_path + ".db.tmp"
+    try:
+        # 用backup API在线拷贝数据库，拷贝期间的写入不会破坏一致性
+        source = connect_chatbot_db(db_path)
+        target = sqlite3.connect(db_copy)
+        try:
+            source.backup(target)
+            target.execute("PRAGMA journal_mode=DELETE")
+            statements = target.execute("SELECT COUNT(*) FROM statement").fetchone()[0]
+        finally:
+            target.close()
+            source.close()
+        
+        # 快照会在机器之间传递，不包含pickle等可执行的序列化内容
+        files = {
+            "xunlian.json": json.dumps(training_data, ensure_ascii=False, indent=2).encode("utf-8")
+        }
+        manifest = {
+            "format": SNAPSHOT_FORMAT,
+            "version": SNAPSHOT_VERSION,
+            "created_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "training_items": len(training_data),
+            "questions": len({pair[0] for pair in map(extract_qa_pair, training_data) if pair}),
+            "statements": statements,
+            "files": {name: hashlib.sha1(data).hexdigest() for name, data in files.items()}
+        }
+        manifest["files"]["chatbot.sqlite3"] = file_sha1(db_copy)
+        
+        temp_path = snapshot_path + ".tmp"
+        with zipfile.ZipFile(temp_path, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr("manifest.json", json.dumps(manifest, ensure_ascii=False, indent=2))
+            for name, data in files.items():
+                archive.writestr(name, data)
+            archive.write(db_copy, "chatbot.sqlite3")
+        os.replace(temp_path, snapshot_path)
+        return manifest
+    finally:
+        if os.path.exists(db_copy):
+            os.remove(db_copy)
+
+def import_knowledge_snapshot(snapshot_path, training_path="xunlian.json", db_path=CHATBOT_DB_PATH):
+    """导入知识快照：恢复训练数据文件和ChatterBot数据库，返回清单；匹配索引由调用方从训练数据重建"""
+    db_copy = db_path + ".snapshot.tmp"
+    try:
+        with zipfile.ZipFile(snapshot_path) as archive:
+            manifest = json.loads(archive.read("manifest.json").decode("utf-8"))
+            if manifest.get("format") != SNAPSHOT_FORMAT or manifest.get("version") not in SNAPSHOT_READABLE_VERSIONS:
+                raise ValueError("不支持的快照格式或版本")
+            training_bytes = archive.read("xunlian.json")
+            with archive.open("chatbot.sqlite3") as source, open(db_copy, "wb") as target:
+                shutil.copyfileobj(source, target, 1 << 20)
+        
+        # 全部文件校验通过后才开始替换本地数据
+        for name, digest in (
+            ("xunlian.json", hashlib.sha1(training_bytes).hexdigest()),
+            ("chatbot.sqlite3", file_sha1(db_copy))
+        ):
+            # SHA1只用于发现传输损坏，不能证明快照来源可信
+            if digest != manifest["files"].get(name):
+                raise ValueError(f"快照文件 {name} 校验失败")
+        
+        temp_path = training_path + ".tmp"
+        with open(temp_path, "wb") as f:
+            f.write(training_bytes)
+        os.replace(temp_path, training_path)
+        
+        # 通过backup API整体替换数据库内容，已打开的连接也会看到一致的新数据
+        source = sqlite3.connect(db_copy)
+        target = connect_chatbot_db(db_path)
+        try:
+            source.backup(target)
+        finally:
+            target.close()
+            source.close()
+        return manifest
+    finally:
+        if os.path.exists(db_copy):
+            os.remove(db_copy)
+
+# 数学适配器只处理含数字运算或英文运算词的输入(mathparse只支持英文)，时间适配器只处理询问时间的输入
+MATH_INPUT_PATTERN = re.compile(
+    r"\d\s*[-+*/^%]|[-+*/^%]\s*\d|\b(?:plus|minus|times|divided|multiplied|squared|cubed|sqrt)\b",
+    re.IGNORECASE
+)
+TIME_INPUT_PATTERN = re.compile(r"\btime\b|几点|现在时间", re.IGNORECASE)
+
+class RoutedAdapterMixin:
+    """逻辑适配器的快速预分类：输入不匹配route_pattern时直接跳过，并统计跳过率和节省的时间"""
+    route_pattern = None
+
+    def __init__(self, chatbot, **kwargs):
+        super().__init__(chatbot, **kwargs)
+        self.route_passed = 0
+        self.route_skipped = 0
+        self.route_seconds = 0.0
+
+    def can_process(self, statement):
+        if not self.route_pattern.search(statement.text):
+            self.route_skipped += 1
+            return False
+        started = time.perf_counter()
+        result = super().can_process(statement)
+        self.route_seconds += time.perf_counter() - started
+        self.route_passed += 1
+        return result
+
+    def route_stats(self):
+        """返回输入数、跳过数、跳过率和按实际处理平均耗时估算的节省秒数"""
+        total = self.route_passed + self.route_skipped
+        average = self.route_seconds / self.route_passed if self.route_passed else 0.0
+        return {
+            "inputs": total,
+            "skipped": self.route_skipped,
+            "skip_rate": self.route_skipped / total if total else 0.0,
+            "saved_seconds": self.route_skipped * average
+        }
+
+class RoutedMathematicalEvaluation(RoutedAdapterMixin, MathematicalEvaluation):
+    """只处理可能包含算式的输入的数学适配器"""
+    route_pattern = MATH_INPUT_PATTERN
+
+class RoutedTimeLogicAdapter(RoutedAdapterMixin, TimeLogicAdapter):
+    """只处理询问时间的输入的时间适配器"""
+    route_pattern = TIME_INPUT_PATTERN
+
+    def process(self, statement, additional_response_selection_parameters=None):
+        # 时间适配器的开销在分类器上，计入实际处理耗时
+        started = time.perf_counter()
+        response = super().process(statement, additional_response_selection_parameters)
+        self.route_seconds += time.perf_counter() - started
+        return response
+
+SCORING_SHARD = []
+
+def init_scoring_shard(keys):
+    """评分进程的初始化函数，保存本进程负责的问题分片"""
+    global SCORING_SHARD
+    SCORING_SHARD = list(keys)
+
+def extend_scoring_shard(keys):
+    """向本进程的问题分片追加新问题"""
+    SCORING_SHARD.extend(keys)
+
+def score_keys(keys, query, limit=5, cutoff=0.6):
+    """逐一计算问题与查询的相似度，返回最高的limit个(相似度, 问题)"""
+    min_length, max_length = similarity_length_bounds(len(query), cutoff)
+    matcher = difflib.SequenceMatcher(None, "", query)
+    heap = []
+    threshold = cutoff
+    for key in keys:
+        if not min_length <= len(key) <= max_length:
+            continue
+        matcher.set_seq1(key)
+        # 先用上界快速排除，再计算精确相似度
+        if matcher.real_quick_ratio() < threshold or matcher.quick_ratio() < threshold:
+            continue
+        similarity = matcher.ratio()
+        if similarity < threshold:
+            continue
+        if len(heap) < limit:
+            heapq.heappush(heap, (similarity, key))
+        else:
+            heapq.heappushpop(heap, (similarity, key))
+        if len(heap) == limit:
+            threshold = max(cutoff, heap[0][0])
+    return sorted(heap, reverse=True)
+
+def score_scoring_shard(query, limit, cutoff):
+    """在评分进程持有的分片中查找最相近的问题"""
+    return score_keys(SCORING_SHARD, query, limit, cutoff)
+
+class ShardedScorer:
+    """把问题语料分片到多个常驻进程中并行计算相似度，语料较小时在当前进程串行计算"""
+    def __init__(self, workers=None, min_corpus_size=20000):
+        self.workers = workers or os.cpu_count() or 1
+        self.min_corpus_size = min_corpus_size
+        self.keys = []
+        self.executors = []
+        self.next_shard = 0
+
+    def start(self):
+        """启动评分进程，每个进程只有一个工作者，常驻持有自己的分片"""
+        for shard in range(self.workers):
+            self.executors.append(ProcessPoolExecutor(
+                max_workers=1,
+                initializer=init_scoring_shard,
+                initargs=(self.keys[shard::self.workers],)
+            ))
+        self.next_shard = len(self.keys) % self.workers
+        # 预热：提前拉起进程并完成分片加载
+        for future in [executor.submit(len, ()) for executor in self.executors]:
+            future.result()
+
+    def add(self, keys):
+        """添加新问题，按轮转顺序分配到各分片"""
+        keys = list(keys)
+        self.keys.extend(keys)
+        if self.executors:
+            shards = [[] for _ in self.executors]
+            for key in keys:
+                shards[self.next_shard].append(key)
+                self.next_shard = (self.next_shard + 1) % len(self.executors)
+            for executor, shard in zip(self.executors, shards):
+                if shard:
+                    executor.submit(extend_scoring_shard, shard)
+        elif self.workers > 1 and len(self.keys) >= self.min_corpus_size:
+            self.start()
+
+    def clear(self):
+        """清空语料并关闭评分进程"""
+        for executor in self.executors:
+            executor.shutdown(wait=False)
+        self.executors = []
+        self.keys = []
+        self.next_shard = 0
+
+    def top(self, query, limit=5, cutoff=0.6):
+        """向所有分片并行查询，合并得到最相近的limit个(相似度, 问题)"""
+        if not self.executors:
+            return score_keys(self.keys, query, limit, cutoff)
+        futures = [executor.submit(score_scoring_shard, query, limit, cutoff) for executor in self.executors]
+        return heapq.nlargest(limit, (item for future in futures for item in future.result()))
+
+class IndexedBestMatch(BestMatch):
+    """基于内存n-gram索引的BestMatch：只对候选短名单计算相似度，数据库新增语句按id增量同步"""
+    REFRESH_SQL = (
+        "SELECT id, in_response_to, text, occurrences FROM statement "
+        "WHERE id > :watermark AND in_response_to IS NOT NULL ORDER BY id"
+    )
+
+    def __init__(self, chatbot, **kwargs):
+        super().__init__(chatbot, **kwargs)
+        self.shortlist_size = kwargs.get("shortlist_size", 40)
+        self.similarity_cutoff = kwargs.get("similarity_cutoff", 0.3)
+        self.scorer = None
+        if kwargs.get("parallel_scoring", False):
+            self.scorer = ShardedScorer(
+                kwargs.get("scoring_workers"),
+                kwargs.get("parallel_min_corpus", 20000)
+            )
+        self.index = NgramIndex()
+        self.responses = {}
+        self.watermark = 0
+        self.lock = threading.Lock()
+
+    def rebuild(self):
+        """清空索引，下次处理时从头同步"""
+        with self.lock:
+            self.index.clear()
+            self.responses = {}
+            self.watermark = 0
+            if self.scorer:
+                self.scorer.clear()
+
+    def refresh(self):
+        """把id大于水位线的新语句加入索引"""
+        with self.chatbot.storage.engine.connect() as connection:
+            max_id = connection.execute(sql_text("SELECT MAX(id) FROM statement")).scalar() or 0
+            if max_id == self.watermark:
+                return
+            if max_id < self.watermark:
+                # 语句被删除或数据库被替换，重新建立索引
+                self.index.clear()
+                self.responses = {}
+                self.watermark = 0
+                if self.scorer:
+                    self.scorer.clear()
+            rows = connection.execute(sql_text(self.REFRESH_SQL), watermark=self.watermark).fetchall()
+        new_keys = []
+        for statement_id, in_response_to, text, occurrences in rows:
+            key = in_response_to.lower()
+            if key not in self.responses:
+                self.responses[key] = Counter()
+                self.index.add(key)
+                new_keys.append(key)
+            # 整理数据库时合并的重复语句记在occurrences中
+            self.responses[key][text] += occurrences
+        if self.scorer and new_keys:
+            self.scorer.add(new_keys)
+        self.watermark = max_id
+
+    def closest_match(self, text):
+        """在候选短名单中找到最相近的已知问题，返回(问题, 相似度)"""
+        if text in self.responses:
+            return text, 1.0
+        closest, confidence = None, 0.0
+        shortlist = self.index.candidates(text, limit=self.shortlist_size, cutoff=self.similarity_cutoff)
+        for candidate in shortlist:
+            similarity = difflib.SequenceMatcher(None, text, candidate).ratio()
+            if similarity > confidence:
+                closest, confidence = candidate, similarity
+                # 与BestMatch一致，足够接近时提前结束
+                if confidence >= self.maximum_similarity_threshold:
+                    break
+        
+        # 只有短名单为空时才对全部语料做一次(分片并行的)完整扫描，避免每条低分查询都回到全量扫描
+        if self.scorer and not shortlist:
+            for similarity, key in self.scorer.top(text, 1, max(self.similarity_cutoff, confidence)):
+                if similarity > confidence:
+                    closest, confidence = key, similarity
+        return closest, confidence
+
+    def process(self, input_statement, additional_response_selection_parameters=None):
+        with self.lock:
+            self.refresh()
+            closest, confidence = self.closest_match(input_statement.text.lower())
+            responses = self.responses.get(closest)
+            response_texts = [response for response, _ in responses.most_common()] if responses else []
+
+        if not response_texts:
+            return self.get_default_response(input_statement)
+
+        recent_repeated_responses = filters.get_recent_repeated_responses(
+            self.chatbot,
+            input_statement.conversation
+        )
+        fresh_texts = [response for response in response_texts if response not in recent_repeated_responses]
+        response_list = [
+            Statement(text=response, in_response_to=closest, conversation=input_statement.conversation)
+            for response in (fresh_texts or response_texts)
+        ]
+        response = self.select_response(input_statement, response_list, self.chatbot.storage)
+        response.confidence = confidence
+        return response
+
+class ResponsePipeline:
+    """分层回复流水线：依次尝试各层，每层有独立的超时和置信度阈值，总预算用完时返回目前最好的回答"""
+    def __init__(self, total_budget=8.0, max_workers=2, inline_tiers=("exact", "fuzzy"), remote_tiers=("api",)):
+        self.total_budget = total_budget
+        self.max_workers = max_workers
+        # 内存中的快速层直接在当前线程执行，不依赖线程池
+        self.inline_tiers = set(inline_tiers)
+        # 远程层只受自身超时限制，不计入本地各层的总预算：按量计费的调用中途放弃也照样收费
+        self.remote_tiers = set(remote_tiers)
+        # 每个慢速层有自己的线程池，某层卡住只占用它自己的线程
+        self.executors = {}
+        self.in_flight = Counter()
+        self.lock = threading.Lock()
+        self.timings = deque(maxlen=1000)
+
+    def submit(self, name, handler, message, timeout):
+        """把慢速层提交到该层的线程池，线程都被占用时返回None"""
+        with self.lock:
+            if self.in_flight[name] >= self.max_workers:
+                return None
+            self.in_flight[name] += 1
+            executor = self.executors.get(name)
+            if executor is None:
+                executor = self.executors[name] = ThreadPoolExecutor(max_workers=self.max_workers)
+        future = executor.submit(handler, message, timeout)
+        future.add_done_callback(lambda _: self.release(name))
+        return future
+
+    def release(self, name):
+        """慢速层的一次调用结束(包括超时后才结束的调用)"""
+        with self.lock:
+            self.in_flight[name] -= 1
+
+    def run(self, message, tiers):
+        """按顺序执行各层(名称, 处理函数, 超时秒数, 阈值)，返回(回答, 置信度, 是否发生超时, 出错层的错误)
+        
+        处理函数接收消息和可用秒数，返回(回答, 置信度)或None；有层出错且没有任何层的回答达到其阈值时抛出最后一个错误，
+        不把低置信度的兜底回答当作出错层的结果
+        """
+        started = time.monotonic()
+        deadline = started + self.total_budget
+        best_answer, best_confidence = None, 0.0
+        timed_out = False
+        answered = False
+        error = None
+        timings = {}
+        for name, handler, timeout, threshold in tiers:
+            tier_started = time.monotonic()
+            if name in self.remote_tiers:
+                remaining = timeout
+            else:
+                remaining = min(timeout, deadline - tier_started)
+                if remaining <= 0:
+                    # 本地预算用完，跳过剩余的本地层，远程层照常尝试
+                    timed_out = True
+                    continue
+            try:
+                if name in self.inline_tiers:
+                    result = handler(message, remaining)
+                else:
+                    future = self.submit(name, handler, message, remaining)
+                    if future is None:
+                        # 该层的线程都还被之前超时的调用占用，跳过而不是排队等待
+                        print(f"回复流水线 {name} 层繁忙，已跳过")
+                        timed_out = True
+                        continue
+                    result = future.result(timeout=remaining)
+            except FutureTimeoutError:
+                # 超时的层在后台自行结束，不再等待
+                print(f"回复流水线 {name} 层超时({remaining:.2f}s)")
+                timed_out = True
+                result = None
+            except Exception as e:
+                print(f"回复流水线 {name} 层出错: {e}")
+                error = e
+                result = None
+            timings[name] = time.monotonic() - tier_started
+            if result is None:
+                continue
+            answer, confidence = result
+            if best_answer is None or confidence > best_confidence:
+                best_answer, best_confidence = answer, confidence
+            if confidence >= threshold:
+                answered = True
+                break
+        timings["total"] = time.monotonic() - started
+        self.timings.append(timings)
+        if error is not None and not answered:
+            raise error
+        return best_answer, best_confidence, timed_out, error
+
+    def latency_summary(self):
+        """统计最近回复各层耗时的p50/p99(毫秒)"""
+        records = list(self.timings)
+        stages = []
+        for record in records:
+            for stage in record:
+                if stage not in stages:
+                    stages.append(stage)
+        summary = {}
+        for stage in stages:
+            values = sorted(record[stage] * 1000 for record in records if stage in record)
+            summary[stage] = {
+                "p50": values[len(values) // 2],
+                "p99": values[min(len(values) - 1, int(len(values) * 0.99))]
+            }
+        return summary
+
 class EnhancedChatApplication:
     def __init__(self, root):
         self.root = root
         self.training_mode = False
         self.training_data = []
+        self.qa_mapping = {}
+        self.qa_sources = {}
+        self.canonical_keys = {}
+        self.question_index = NgramIndex()
+        self.prompt_index = ShingleIndex()
+        self.tfidf_matcher = None
+        self.bk_tree = None
+        self.duplicate_detector = None
+        self.chatbot = None  # 聊天引擎在后台线程中构建，就绪前为None
+        self.pending_training = []  # 聊天引擎就绪前学习的对话，就绪后再写入数据库
+        self.knowledge_lock = threading.RLock()  # 导入线程和回复线程共享训练数据与匹配索引，读写都在锁内进行
+        self.import_job = None  # 正在后台进行的训练文件导入
+        self.matcher = "ngram"  # ngram, bktree
+        self.answer_threshold = 0.6  # 本地检索得分低于该值时交给ChatterBot
+        self.retrieval_timings = deque(maxlen=1000)
+        self.response_cache = ResponseCache()
+        self.response_pipeline = ResponsePipeline(total_budget=5.0)
         self.setup_window()
         self.current_theme = self.detect_system_theme()
         self.setup_theme()
-        self.setup_chatbot()
         self.setup_ui()
         self.bind_events()
+        self.training_journal = TrainingJournal()
+        self.import_startup_snapshot()
         self.load_training_data()
-        self.qa_mapping = {}
-        self.build_qa_mapping()
+        self.start_chatbot_setup()
 
     def build_qa_mapping(self):
         """构建问题和答案的映射关系"""
         self.qa_mapping = {}
+        self.qa_sources = {}
+        self.canonical_keys = {}
+        self.question_index.clear()
+        self.prompt_index.clear()
+        self.tfidf_matcher = None
+        self.bk_tree = None
+        self.duplicate_detector = None
         for item in self.training_data:
-            if isinstance(item, dict):
-                # 支持多种数据格式
-                if "question" in item and "answer" in item:
-                    question = item.get("question", "").strip().lower()
-                    answer = item.get("answer", "")
-                    if isinstance(answer, list):
-                        answer = answer[0] if answer else ""
-                    if question and answer:
-                        self.qa_mapping[question] = answer
-                elif "input" in item and ("target" in item or "answer" in item):
-                    question = item.get("input", "").strip().lower()
-                    answer = item.get("target", item.get("answer", ""))
-                    if question and answer:
-                        self.qa_mapping[question] = answer
+            self.add_qa_item(item)
 
-    def find_similar_question(self, user_question):
-        """查找语义相近的问题"""
-        user_question = user_question.lower().strip()
+    def add_qa_item(self, item):
+        """增量添加一条训练数据到映射和匹配索引"""
+        pair = extract_qa_pair(item)
+        if pair is None:
+            return
+        question, answer = pair
+        answers = self.qa_sources.get(question)
+        if answers is None:
+            answers = self.qa_sources[question] = []
+            self.get_match_index(question).add(question)
+            if self.bk_tree is not None:
+                self.bk_tree.add(question)
+            if self.duplicate_detector is not None:
+                self.duplicate_detector.add(question)
+            # 规范化键只在问题首次出现时计算一次
+            canonical = canonicalize_question(question)
+            if canonical:
+                self.canonical_keys.setdefault(canonical, []).append(question)
+            # TF-IDF矩阵的IDF依赖全部问题，只标记失效，下次批量查询时重建
+            self.tfidf_matcher = None
+        answers.append(answer)
+        # 与全量构建一致，同一问题以最后出现的答案为准
+        self.qa_mapping[question] = answer
+
+    def remove_qa_item(self, item):
+        """增量移除一条训练数据"""
+        pair = extract_qa_pair(item)
+        if pair is None:
+            return
+        question, answer = pair
+        answers = self.qa_sources.get(question)
+        if not answers or answer not in answers:
+            return
+        answers.remove(answer)
+        if answers:
+            self.qa_mapping[question] = answers[-1]
+        else:
+            del self.qa_sources[question]
+            del self.qa_mapping[question]
+            self.get_match_index(question).remove(question)
+            if self.bk_tree is not None:
+                self.bk_tree.remove(question)
+            if self.duplicate_detector is not None:
+                self.duplicate_detector.remove(question)
+            canonical = canonicalize_question(question)
+            variants = self.canonical_keys.get(canonical)
+            if variants and question in variants:
+                variants.remove(question)
+                if not variants:
+                    del self.canonical_keys[canonical]
+            self.tfidf_matcher = None
+
+    def update_qa_item(self, old_item, new_item):
+        """增量更新一条训练数据"""
+        self.remove_qa_item(old_item)
+        self.add_qa_item(new_item)
+
+    def get_match_index(self, question):
+        """长提示词类问题放入单独的分片索引，其余放入n-gram索引"""
+        if len(question) > LONG_QUESTION_LENGTH:
+            return self.prompt_index
+        return self.question_index
+
+    def match_candidates(self, query, cutoff=0.6, indexes=None):
+        """从n-gram索引和长提示词索引中筛选候选问题；indexes为(n-gram索引, 长提示词索引)，默认使用知识库当前的索引"""
+        question_index, prompt_index = indexes or (self.question_index, self.prompt_index)
+        min_length, max_length = similarity_length_bounds(len(query), cutoff)
+        questions = []
+        if min_length <= LONG_QUESTION_LENGTH:
+            questions.extend(question_index.candidates(query, cutoff=cutoff))
+        # 只有查询足够长时才可能匹配长提示词，短对话不需要与长文本比较
+        if max_length > LONG_QUESTION_LENGTH:
+            questions.extend(prompt_index.candidates(query, limit=10, cutoff=cutoff))
+        return questions
+
+    def retrieve(self, user_question, k=5, cutoff=0.6):
+        """检索最相近的k个问题，返回[(问题, 答案, 得分)]列表和各阶段耗时"""
+        timings = {"exact": 0.0, "shortlist": 0.0, "rescore": 0.0}
+        started = time.perf_counter()
+        query = user_question.lower().strip()
+        results = []
         
-        if user_question in self.qa_mapping:
-            return user_question
+        exact = self.find_exact_question(query)
+        if exact is not None:
+            results.append((exact, self.qa_mapping[exact], 1.0))
+        stage_end = time.perf_counter()
+        timings["exact"] = stage_end - started
+        
+        if exact is None or k > 1:
+            stage_start = stage_end
+            if self.matcher == "bktree" and len(query) <= self.get_bk_tree().max_key_length:
+                scored = self.get_bk_tree().scored(query, cutoff)
+                stage_end = time.perf_counter()
+                timings["shortlist"] = stage_end - stage_start
+            else:
+                # 先用倒排索引筛选少量候选，再做difflib评分
+                candidates = self.match_candidates(query, cutoff=cutoff)
+                stage_end = time.perf_counter()
+                timings["shortlist"] = stage_end - stage_start
+                scored = []
+                matcher = difflib.SequenceMatcher()
+                matcher.set_seq2(query)
+                for question in candidates:
+                    matcher.set_seq1(question)
+                    # 与difflib.get_close_matches相同的逐级筛选
+                    if matcher.real_quick_ratio() >= cutoff and matcher.quick_ratio() >= cutoff:
+                        ratio = matcher.ratio()
+                        if ratio >= cutoff:
+                            scored.append((ratio, question))
             
-        questions = list(self.qa_mapping.keys())
-        matches = difflib.get_close_matches(user_question, questions, n=1, cutoff=0.6)
+            for score, question in heapq.nlargest(k, scored):
+                if question != exact and question in self.qa_mapping:
+                    results.append((question, self.qa_mapping[question], score))
+            timings["rescore"] = time.perf_counter() - stage_end
         
-        if matches:
-            return matches[0]
+        timings["total"] = time.perf_counter() - started
+        self.retrieval_timings.append(timings)
+        return results[:k], timings
+
+    def find_exact_question(self, query):
+        """查找与查询完全相同或规范化后相同的问题，没有时返回None"""
+        if query in self.qa_mapping:
+            return query
+        # 全角半角、结尾标点、表情和多余空格等变体通过规范化键直接命中
+        variants = self.canonical_keys.get(canonicalize_question(query))
+        if variants:
+            return variants[-1]
+        return None
+
+    def find_similar_question(self, user_question):
+        """查找语义相近的问题"""
+        results, _ = self.retrieve(user_question, k=1, cutoff=0.6)
+        if results:
+            return results[0][0]
             
         return None
 
+    def latency_summary(self):
+        """统计最近检索各阶段耗时的p50/p99(毫秒)"""
+        summary = {}
+        records = list(self.retrieval_timings)
+        for stage in ("exact", "shortlist", "rescore", "total"):
+            values = sorted(record[stage] * 1000 for record in records)
+            if values:
+                summary[stage] = {
+                    "p50": values[len(values) // 2],
+                    "p99": values[min(len(values) - 1, int(len(values) * 0.99))]
+                }
+        return summary
+
+    def get_bk_tree(self):
+        """按需构建BK树，之后随训练数据增量维护"""
+        if self.bk_tree is None:
+            tree = BKTree()
+            for question in list(self.qa_mapping):
+                tree.add(question)
+            self.bk_tree = tree
+        return self.bk_tree
+
+    def get_duplicate_detector(self):
+        """按需构建近似重复检测器，之后随训练数据增量维护"""
+        if self.duplicate_detector is None:
+            detector = MinHashLSH()
+            for question in list(self.qa_mapping):
+                detector.add(question)
+            self.duplicate_detector = detector
+        return self.duplicate_detector
+
+    def is_near_duplicate(self, question, answer):
+        """问题与已有问题近似且答案相同时视为重复"""
+        answer_text = str(answer).strip()
+        for key in self.get_duplicate_detector().query(question.strip().lower()):
+            if any(str(existing).strip() == answer_text for existing in self.qa_sources.get(key, ())):
+                return True
+        return False
+
+    def benchmark_matchers(self, queries=None, sample_size=200):
+        """对比全量difflib、n-gram索引和BK树三种匹配方式的耗时
+        
+        只在知识库锁内复制问题列表，索引和BK树在副本上重建后再计时，基准测试期间回复不受影响
+        """
+        with self.knowledge_lock:
+            questions = list(self.qa_mapping.keys())
+        question_index, prompt_index = NgramIndex(), ShingleIndex()
+        for question in questions:
+            (prompt_index if len(question) > LONG_QUESTION_LENGTH else question_index).add(question)
+        indexes = (question_index, prompt_index)
+        if queries is None:
+            sample = random.sample(questions, min(sample_size, len(questions)))
+            # 删掉中间一个字符模拟用户输入的变体
+            queries = [q[:len(q) // 2] + q[len(q) // 2 + 1:] if len(q) > 2 else q for q in sample]
+        queries = [q.lower().strip() for q in queries]
+        
+        start = time.perf_counter()
+        tree = BKTree()
+        for question in questions:
+            tree.add(question)
+        results = {"bktree_build": time.perf_counter() - start, "queries": len(queries)}
+        
+        matchers = {
+            "difflib": lambda q: difflib.get_close_matches(q, questions, n=1, cutoff=0.6),
+            "ngram": lambda q: difflib.get_close_matches(
+                q, self.match_candidates(q, cutoff=0.6, indexes=indexes), n=1, cutoff=0.6
+            ),
+            "bktree": lambda q: tree.find(q, cutoff=0.6)
+        }
+        for name, matcher in matchers.items():
+            found = 0
+            start = time.perf_counter()
+            for query in queries:
+                if matcher(query):
+                    found += 1
+            elapsed = time.perf_counter() - start
+            results[name] = {
+                "total": elapsed,
+                "per_query_ms": elapsed * 1000 / max(len(queries), 1),
+                "found": found
+            }
+        return results
+
+    def run_matcher_benchmark(self):
+        """在后台运行匹配基准测试并显示结果"""
+        def worker():
+            results = self.benchmark_matchers()
+            lines = [f"匹配基准测试 ({results['queries']} 条查询，BK树构建 {results['bktree_build']:.2f}s):"]
+            for name in ("difflib", "ngram", "bktree"):
+                result = results[name]
+                lines.append(f"{name}: {result['per_query_ms']:.2f}ms/条，命中 {result['found']} 条")
+            self.root.after(0, self.display_message, "系统", "\n".join(lines), "system")
+        
+        threading.Thread(target=worker, daemon=True).start()
+
+    def show_performance_stats(self):
+        """显示回复缓存命中率和检索耗时统计"""
+        cache = self.response_cache.stats()
+        lines = [f"回复缓存: {cache['size']} 条，命中 {cache['hits']} 次，未命中 {cache['misses']} 次，命中率 {cache['hit_rate']:.0%}"]
+        for stage, values in self.latency_summary().items():
+            lines.append(f"检索 {stage}: p50 {values['p50']:.2f}ms，p99 {values['p99']:.2f}ms")
+        for stage, values in self.response_pipeline.latency_summary().items():
+            lines.append(f"回复 {stage}: p50 {values['p50']:.2f}ms，p99 {values['p99']:.2f}ms")
+        if self.chatbot is not None:
+            for adapter in self.chatbot.logic_adapters:
+                if isinstance(adapter, RoutedAdapterMixin):
+                    stats = adapter.route_stats()
+                    lines.append(
+                        f"适配器 {adapter.class_name}: 跳过 {stats['skipped']}/{stats['inputs']} 条({stats['skip_rate']:.0%})，"
+                        f"约节省 {stats['saved_seconds'] * 1000:.1f}ms"
+                    )
+        self.display_message("系统", "\n".join(lines), "system")
+
+    def run_db_compaction(self):
+        """在后台整理ChatterBot数据库，显示整理前后的大小和查询耗时"""
+        if self.chatbot is None:
+            self.display_message("系统", "聊天引擎就绪后才能整理数据库", "error")
+            return
+        if self.import_job is not None:
+            self.display_message("系统", "训练文件导入期间不能整理数据库", "error")
+            return
+        
+        def worker():
+            try:
+                # 先归还连接池中的空闲连接，VACUUM需要独占数据库
+                self.chatbot.storage.engine.dispose()
+                result = compact_chatbot_db()
+                for adapter in self.chatbot.logic_adapters:
+                    if isinstance(adapter, IndexedBestMatch):
+                        adapter.rebuild()
+                self.response_cache.clear()
+                lines = [
+                    f"数据库整理完成: 语句 {result['statements_before']} → {result['statements_after']} 条，"
+                    f"合并重复 {result['merged']} 条，清理孤立记录 {result['orphans']} 条",
+                    f"文件大小: {result['size_before'] / 1024 / 1024:.2f}MB → {result['size_after'] / 1024 / 1024:.2f}MB",
+                    f"查询耗时: {result['latency_before']:.3f}ms → {result['latency_after']:.3f}ms"
+                ]
+                self.root.after(0, self.display_message, "系统", "\n".join(lines), "system")
+            except Exception as e:
+                self.root.after(0, self.display_message, "系统", f"整理数据库失败: {str(e)}", "error")
+        
+        self.display_message("系统", "正在整理数据库...", "system")
+        threading.Thread(target=worker, daemon=True).start()
+
+    def find_similar_questions(self, batch, k=5):
+        """批量查找相似问题，为每个问题返回得分最高的k个(问题, 得分)"""
+        queries = [question.lower().strip() for question in batch]
+        
+        if np is None or sparse is None:
+            # 没有numpy/scipy时逐条用索引筛选并按difflib得分排序
+            results = []
+            for query in queries:
+                scored = [
+                    (question, difflib.SequenceMatcher(None, query, question).ratio())
+                    for question in self.match_candidates(query)
+                ]
+                results.append(heapq.nlargest(k, scored, key=lambda pair: pair[1]))
+            return results
+            
+        if self.tfidf_matcher is None:
+            self.tfidf_matcher = TfidfMatcher()
+            self.tfidf_matcher.build(self.qa_mapping.keys())
+        return self.tfidf_matcher.find_similar_questions(queries, k)
+
     def setup_window(self):
         """配置主窗口属性"""
         self.root.title("小梓聊天助手")
@@ -155,58 +2379,213 @@ class EnhancedChatApplication:
         except Exception as e:
             print(f"窗口特效设置失败: {e}")
 
+    def load_index_cache(self):
+        """从旁路索引文件恢复训练数据和匹配索引，成功返回True"""
+        try:
+            payload = read_index_sidecar("xunlian.idx", "xunlian.json")
+        except Exception as e:
+            print(f"读取索引缓存失败: {e}")
+            return False
+        if payload is None:
+            return False
+        return self.apply_index_payload(payload)
+
+    def apply_index_payload(self, payload):
+        """用索引缓存中的内容替换训练数据和匹配索引，内容与当前索引参数不一致时返回False"""
+        question_index = NgramIndex()
+        prompt_index = ShingleIndex()
+        if not question_index.load_state(payload["question_index"]):
+            return False
+        if not prompt_index.load_state(payload["prompt_index"]):
+            return False
+        self.training_data = payload["training_data"]
+        self.qa_mapping = payload["qa_mapping"]
+        self.qa_sources = payload["qa_sources"]
+        self.canonical_keys = payload["canonical_keys"]
+        self.question_index = question_index
+        self.prompt_index = prompt_index
+        self.tfidf_matcher = None
+        self.bk_tree = None
+        self.duplicate_detector = None
+        return True
+
+    def save_index_cache(self):
+        """把当前的训练数据和匹配索引写入旁路索引文件"""
+        if not os.path.exists("xunlian.json"):
+            return
+        try:
+            write_index_sidecar("xunlian.idx", "xunlian.json", self.index_cache_payload())
+        except Exception as e:
+            print(f"保存索引缓存失败: {e}")
+
+    def index_cache_payload(self):
+        """当前训练数据和匹配索引的可持久化内容"""
+        return {
+            "training_data": self.training_data,
+            "qa_mapping": self.qa_mapping,
+            "qa_sources": self.qa_sources,
+            "canonical_keys": self.canonical_keys,
+            "question_index": self.question_index.export_state(),
+            "prompt_index": self.prompt_index.export_state()
+        }
+
+    def import_startup_snapshot(self):
+        """全新安装且存在知识快照时直接导入，省去首次训练"""
+        if os.path.exists(CHATBOT_DB_PATH) or not os.path.exists(KNOWLEDGE_SNAPSHOT_PATH):
+            return
+        # 已有本地训练数据(例如导出快照后删除数据库重新训练)时不自动导入，避免覆盖训练数据和未合并的日志
+        journal = self.training_journal
+        if any(os.path.exists(path) for path in ("xunlian.json", journal.journal_path, journal.rotated_path)):
+            print("已有本地训练数据，跳过自动导入知识快照")
+            return
+        try:
+            manifest = import_knowledge_snapshot(KNOWLEDGE_SNAPSHOT_PATH)
+            print(f"已导入知识快照: {manifest['training_items']} 条训练数据，{manifest['statements']} 条语句")
+        except Exception as e:
+            print(f"导入知识快照失败: {e}")
+
+    def export_snapshot(self):
+        """导出知识快照"""
+        if self.chatbot is None:
+            self.display_message("系统", "聊天引擎就绪后才能导出快照", "error")
+            return
+        file_path = filedialog.asksaveasfilename(
+            title="导出知识快照",
+            defaultextension=".zip",
+            initialfile=KNOWLEDGE_SNAPSHOT_PATH,
+            filetypes=[("知识快照", "*.zip")]
+        )
+        if not file_path:
+            self.display_message("系统", "已取消导出", "system")
+            return
+        try:
+            manifest = export_knowledge_snapshot(file_path, self.training_data)
+            self.display_message(
+                "系统",
+                f"已导出知识快照: {manifest['training_items']} 条训练数据，{manifest['statements']} 条语句",
+                "system"
+            )
+        except Exception as e:
+            self.display_message("系统", f"导出快照失败: {str(e)}", "error")
+
+    def import_snapshot(self):
+        """导入知识快照，替换训练数据、匹配索引和ChatterBot数据库"""
+        if self.chatbot is None:
+            self.display_message("系统", "聊天引擎就绪后才能导入快照", "error")
+            return
+        if self.import_job is not None:
+            self.display_message("系统", "训练文件导入期间不能导入快照", "error")
+            return
+        file_path = filedialog.askopenfilename(
+            title="选择知识快照",
+            filetypes=[("知识快照", "*.zip")],
+            initialdir=os.path.expanduser("~")
+        )
+        if not file_path:
+            self.display_message("系统", "已取消文件选择", "system")
+            return
+        try:
+            self.chatbot.storage.engine.dispose()
+            # 后台压缩可能正在写xunlian.json，等它完成后再整体替换
+            self.training_journal.wait()
+            manifest = import_knowledge_snapshot(file_path)
+            self.training_journal.reset()
+            # 从导入的训练数据重建匹配索引和旁路索引
+            with self.knowledge_lock:
+                self.load_training_data()
+            for adapter in self.chatbot.logic_adapters:
+                if isinstance(adapter, IndexedBestMatch):
+                    adapter.rebuild()
+            self.response_cache.clear()
+            self.display_message(
+                "系统",
+                f"已导入知识快照: {manifest['training_items']} 条训练数据，{manifest['statements']} 条语句",
+                "system"
+            )
+        except Exception as e:
+            self.display_message("系统", f"导入快照失败: {str(e)}", "error")
+
     def load_training_data(self):
-        """加载训练数据，支持多种格式"""
+        """加载训练数据：先加载xunlian.json，再按顺序重放追加日志"""
+        try:
+            self.training_journal.recover()
+        except Exception as e:
+            print(f"恢复训练日志失败: {e}")
+        # xunlian.json未变化时直接映射索引文件，跳过解析、去重和建索引
+        rewrite = False
+        if self.load_index_cache():
+            print(f"已从索引缓存加载 {len(self.training_data)} 条训练数据")
+        else:
+            rewrite = self.load_base_training_data()
+        self.replay_training_journal()
+        if rewrite:
+            # 写回修复后的数据，下次启动不再重复修复和隔离同样的记录
+            self.training_journal.compact(list(self.training_data))
+
+    def replay_training_journal(self):
+        """把追加日志中尚未合并的条目加入训练数据，条目较多时在后台压缩"""
+        count = 0
+        try:
+            for item in self.training_journal.replay():
+                self.training_data.append(item)
+                self.add_qa_item(item)
+                count += 1
+        except Exception as e:
+            print(f"重放训练日志失败: {e}")
+        if count:
+            print(f"已从追加日志恢复 {count} 条训练数据")
+        if self.training_journal.pending >= self.training_journal.compact_threshold:
+            self.training_journal.compact(list(self.training_data))
+
+    def load_base_training_data(self):
+        """解析xunlian.json，支持多种格式；只有记录被修复、没有记录被隔离时返回True"""
+        loaded = False
+        rewrite = False
+        self.training_data = []
+        self.build_qa_mapping()
         try:
             if os.path.exists("xunlian.json"):
-                with open("xunlian.json", "r", encoding="utf-8") as f:
-                    content = f.read().strip()
-                    
-                    if not content:
-                        self.training_data = []
-                        return
-                    
-                    # 尝试解析JSON
-                    try:
-                        # 处理可能的多行JSON格式
-                        if content.startswith("[") and content.endswith("]"):
-                            self.training_data = json.loads(content)
-                        else:
-                            # 处理每行一个JSON对象的情况
-                            lines = [line.strip() for line in content.split("\n") if line.strip()]
-                            self.training_data = [json.loads(line) for line in lines]
-                            
-                        print(f"已加载 {len(self.training_data)} 条训练数据")
-                    except json.JSONDecodeError as e:
-                        print(f"JSON解析错误: {e}")
-                        # 尝试修复格式错误的JSON
+                # 逐条流式读取并建立索引；格式错误的记录逐条修复，无法修复的隔离到拒收文件
+                recovery = TrainingRecordRecovery("xunlian.json")
+                try:
+                    for item in iter_training_items("xunlian.json", recovery=recovery):
+                        self.training_data.append(item)
+                        self.add_qa_item(item)
+                finally:
+                    recovery.close()
+                print(f"已加载 {len(self.training_data)} 条训练数据")
+                summary = recovery.summary()
+                if summary is not None:
+                    if recovery.rejected:
+                        # 有记录被隔离时不写回修复结果；之后的压缩也会重写主文件，先保留完整备份
+                        backup_name = f"xunlian_bak_{int(time.time())}.json"
                         try:
-                            content = content.replace("'", "\"")
-                            content = content.replace("True", "true").replace("False", "false")
-                            content = content.replace(",\n}", "\n}").replace(",\n]", "\n]")
-                            
-                            # 再次尝试解析
-                            if content.startswith("[") and content.endswith("]"):
-                                self.training_data = json.loads(content)
-                            else:
-                                lines = [line.strip() for line in content.split("\n") if line.strip()]
-                                self.training_data = [json.loads(line) for line in lines]
-                                
-                            print(f"修复后成功加载 {len(self.training_data)} 条训练数据")
-                        except json.JSONDecodeError as e2:
-                            print(f"修复JSON失败: {e2}")
-                            backup_name = f"xunlian_bak_{int(time.time())}.json"
-                            with open(backup_name, "w", encoding="utf-8") as bak:
-                                bak.write(content)
-                            print(f"已创建备份文件: {backup_name}")
-                            self.training_data = []
-                            self.display_message("系统", "训练数据文件损坏，已创建备份并初始化空数据", "error")
+                            shutil.copy2("xunlian.json", backup_name)
+                            summary += f"，原文件已备份到 {backup_name}"
+                        except OSError as e:
+                            print(f"创建备份文件失败: {e}")
+                    else:
+                        rewrite = True
+                    print(summary)
+                    self.display_message("系统", summary, "error" if recovery.rejected else "system")
+                loaded = True
         except Exception as e:
             print(f"加载训练数据失败: {e}")
+            # 无法逐条读取(例如编码错误)时保留原文件备份，避免后续保存覆盖
+            backup_name = f"xunlian_bak_{int(time.time())}.json"
+            try:
+                shutil.copy2("xunlian.json", backup_name)
+                print(f"已创建备份文件: {backup_name}")
+                self.display_message("系统", "训练数据文件损坏，已创建备份并初始化空数据", "error")
+            except OSError as e2:
+                print(f"创建备份文件失败: {e2}")
             self.training_data = []
+            self.build_qa_mapping()
         
         self.load_default_training_data()
-        self.build_qa_mapping()
+        if loaded:
+            self.save_index_cache()
+        return rewrite
 
     def load_default_training_data(self):
         """加载内置的日常对话训练数据"""
@@ -257,15 +2636,24 @@ class EnhancedChatApplication:
         for item in default_data:
             if "question" in item and item["question"].lower() not in existing_questions:
                 self.training_data.append(item)
+                self.add_qa_item(item)
             elif "input" in item and item["input"].lower() not in existing_questions:
                 self.training_data.append(item)
+                self.add_qa_item(item)
 
     def save_training_data(self):
-        """保存训练数据"""
+        """保存训练数据：在后台把全部数据写成新的xunlian.json并原子替换"""
         try:
-            with open("xunlian.json", "w", encoding="utf-8") as f:
-                json.dump(self.training_data, f, ensure_ascii=False, indent=2)
-                print(f"已保存 {len(self.training_data)} 条训练数据")
+            self.training_journal.compact(list(self.training_data), wait=True)
+        except Exception as e:
+            print(f"保存训练数据失败: {e}")
+            self.display_message("系统", f"保存训练数据失败: {str(e)}", "error")
+
+    def append_training_items(self, items):
+        """把新学到的条目追加到日志，积累到阈值后再在后台整体压缩"""
+        try:
+            if self.training_journal.append(items):
+                self.training_journal.compact(list(self.training_data))
         except Exception as e:
             print(f"保存训练数据失败: {e}")
             self.display_message("系统", f"保存训练数据失败: {str(e)}", "error")
@@ -288,23 +2676,34 @@ class EnhancedChatApplication:
         sv_ttk.set_theme(self.current_theme)
         self.theme_animation = ThemeTransition(self.root, self.switch_theme)
 
+    def start_chatbot_setup(self):
+        """在后台线程中构建聊天引擎，界面无需等待"""
+        threading.Thread(target=self.setup_chatbot, daemon=True).start()
+
     def setup_chatbot(self):
-        """配置ChatterBot聊天机器人"""
+        """配置ChatterBot聊天机器人(在后台线程中运行)"""
         try:
-            self.chatbot = ChatBot(
+            # 数据库文件由ChatBot()创建，此后到登记来源之间还要加载语料；
+            # 先写入首次训练标记，期间退出或出错时下次启动仍会继续首次训练
+            if not os.path.exists(CHATBOT_DB_PATH):
+                BulkTrainer.mark_first_run()
+            first_run = BulkTrainer.first_run_pending()
+            chatbot = ChatBot(
                 "Win11ChatBot",
                 storage_adapter="chatterbot.storage.SQLStorageAdapter",
-                database_uri="sqlite:///win11_chatbot_db.sqlite3",
+                database_uri=f"sqlite:///{CHATBOT_DB_PATH}",
                 logic_adapters=[
                     {
-                        "import_path": "chatterbot.logic.BestMatch",
+                        "import_path": f"{__name__}.IndexedBestMatch",
                         "default_response": "我还在学习中，请换种方式提问",
                         "maximum_similarity_threshold": 0.85,
-                        "response_selection_method": get_most_frequent_response,
-                        "statement_comparison_function": LevenshteinDistance
+                        # IndexedBestMatch已按出现次数(含合并的重复语句)排列候选回复
+                        "response_selection_method": get_first_response,
+                        "statement_comparison_function": LevenshteinDistance,
+                        "parallel_scoring": False
                     },
-                    "chatterbot.logic.MathematicalEvaluation",
-                    "chatterbot.logic.TimeLogicAdapter"
+                    f"{__name__}.RoutedMathematicalEvaluation",
+                    f"{__name__}.RoutedTimeLogicAdapter"
                 ],
                 preprocessors=[
                     'chatterbot.preprocessors.clean_whitespace',
@@ -312,58 +2711,135 @@ class EnhancedChatApplication:
                 ],
                 filters=["chatterbot.filters.get_recent_repeated_responses"]
             )
+            self.setup_chatbot_storage(chatbot)
+            upgrade_chatbot_db()
             
-            if not os.path.exists("win11_chatbot_db.sqlite3"):
-                self.train_chatbot()
+            # 首次运行或上次首次训练被中断时，从检查点继续训练
+            trainer = BulkTrainer(chatbot, progress_callback=self.report_training_progress)
+            if first_run or trainer.pending_sources():
+                self.root.after(0, self.set_chatbot_status, "聊天引擎首次训练中...")
+                self.train_chatbot(trainer, first_run)
+            # 提前建立检索索引，避免第一条消息等待
+            for adapter in chatbot.logic_adapters:
+                if isinstance(adapter, IndexedBestMatch):
+                    with adapter.lock:
+                        adapter.refresh()
+            self.root.after(0, self.on_chatbot_ready, chatbot)
         except Exception as e:
-            messagebox.showerror("错误", f"聊天机器人初始化失败: {str(e)}")
-            sys.exit(1)
+            self.root.after(0, self.on_chatbot_failed, str(e))
+
+    def on_chatbot_ready(self, chatbot):
+        """聊天引擎构建完成(在界面线程中调用)"""
+        self.chatbot = chatbot
+        self.flush_pending_training()
+        self.set_chatbot_status("聊天引擎已就绪")
 
-    def train_chatbot(self):
-        """训练聊天机器人，支持多种数据格式"""
+    def flush_pending_training(self):
+        """在后台把聊天引擎就绪前学习的对话写入数据库，导入大文件时不阻塞界面"""
+        with self.knowledge_lock:
+            conversations = self.pending_training
+            self.pending_training = []
+        if not conversations:
+            return
+        
+        def worker():
+            try:
+                BulkTrainer(self.chatbot).train(conversations)
+            except Exception as e:
+                print(f"写入待训练对话失败: {e}")
+        
+        threading.Thread(target=worker, daemon=True).start()
+
+    def on_chatbot_failed(self, error):
+        """聊天引擎构建失败，继续只使用本地知识库"""
+        self.set_chatbot_status("聊天引擎不可用，仅使用本地知识库")
+        messagebox.showerror("错误", f"聊天机器人初始化失败: {error}")
+
+    def set_chatbot_status(self, text):
+        """更新聊天引擎状态提示"""
+        self.status_label.config(text=text)
+
+    def setup_chatbot_storage(self, chatbot):
+        """用带连接池和WAL参数的引擎替换存储适配器默认的引擎"""
+        storage = chatbot.storage
+        storage.engine.dispose()
+        storage.engine = create_chatbot_engine()
+        storage.Session = sessionmaker(bind=storage.engine, expire_on_commit=True)
+
+    def first_run_sources(self):
+        """首次训练的数据来源：[(来源名称, 对话列表, 标签)]，支持多种数据格式"""
+        sources = []
+        corpus_files = []
+        for corpus_path in ("chatterbot.corpus.english.greetings", "chatterbot.corpus.english.conversations"):
+            corpus_files.extend(list_corpus_files(corpus_path))
+        for corpus, categories, file_path in load_corpus(*corpus_files):
+            sources.append((f"corpus:{os.path.basename(file_path)}", corpus, categories))
+        
+        conversations = []
+        for item in list(self.training_data):
+            if isinstance(item, dict):
+                # 标准问答格式
+                if "question" in item and "answer" in item:
+                    question = item.get("question", "")
+                    answer = item.get("answer", "")
+                    if isinstance(answer, list):
+                        answer = answer[0] if answer else ""
+                    if question and answer:
+                        conversations.append([question, answer])
+                # 新增支持的任务格式
+                elif "input" in item and ("target" in item or "answer" in item):
+                    question = item.get("input", "")
+                    answer = item.get("target", item.get("answer", ""))
+                    if question and answer:
+                        conversations.append([question, answer])
+        sources.append(("xunlian.json", conversations, []))
+        
+        chinese_pairs = [
+            ["你好", "你好啊！我是Windows 11聊天助手"],
+            ["你是谁", "我是基于ChatterBot开发的AI聊天机器人"],
+            ["你会什么", "我可以和你聊天，回答简单问题，还能切换深色/浅色主题哦"],
+            ["切换主题", "点击右上角的月亮/太阳图标可以切换主题"],
+            ["谢谢", "不客气，很高兴能帮到你"],
+            ["再见", "再见，祝你有个愉快的一天！"],
+            ["今天天气怎么样", "我无法获取实时天气，建议查看天气应用"],
+            ["你多大了", "我是一个AI程序，没有实际年龄概念"],
+            ["讲个笑话", "为什么电脑很笨？因为它只会听从指令！"],
+            ["帮助", "我可以回答简单问题、聊天和切换主题，试试问我'你会什么'"]
+        ]
+        sources.append(("chinese_pairs", chinese_pairs, []))
+        return sources
+
+    def train_chatbot(self, trainer, first_run):
+        """首次训练聊天机器人：按来源分批提交并记录检查点，中断后下次启动从检查点继续"""
         try:
-            corpus_trainer = ChatterBotCorpusTrainer(self.chatbot)
-            corpus_trainer.train(
-                "chatterbot.corpus.english.greetings",
-                "chatterbot.corpus.english.conversations"
-            )
-            
-            list_trainer = ListTrainer(self.chatbot)
-            
-            for item in self.training_data:
-                if isinstance(item, dict):
-                    # 标准问答格式
-                    if "question" in item and "answer" in item:
-                        question = item.get("question", "")
-                        answer = item.get("answer", "")
-                        if isinstance(answer, list):
-                            answer = answer[0] if answer else ""
-                        if question and answer:
-                            list_trainer.train([question, answer])
-                    # 新增支持的任务格式
-                    elif "input" in item and ("target" in item or "answer" in item):
-                        question = item.get("input", "")
-                        answer = item.get("target", item.get("answer", ""))
-                        if question and answer:
-                            list_trainer.train([question, answer])
-            
-            chinese_pairs = [
-                ["你好", "你好啊！我是Windows 11聊天助手"],
-                ["你是谁", "我是基于ChatterBot开发的AI聊天机器人"],
-                ["你会什么", "我可以和你聊天，回答简单问题，还能切换深色/浅色主题哦"],
-                ["切换主题", "点击右上角的月亮/太阳图标可以切换主题"],
-                ["谢谢", "不客气，很高兴能帮到你"],
-                ["再见", "再见，祝你有个愉快的一天！"],
-                ["今天天气怎么样", "我无法获取实时天气，建议查看天气应用"],
-                ["你多大了", "我是一个AI程序，没有实际年龄概念"],
-                ["讲个笑话", "为什么电脑很笨？因为它只会听从指令！"],
-                ["帮助", "我可以回答简单问题、聊天和切换主题，试试问我'你会什么'"]
-            ]
-            for pair in chinese_pairs:
-                list_trainer.train(pair)
-                
+            sources = self.first_run_sources()
+            if first_run:
+                trainer.register_sources([(name, len(conversations)) for name, conversations, _ in sources])
+            pending = trainer.pending_sources()
+            self.training_progress = {
+                "base": 0,
+                "total": sum(total - position for position, total in pending.values()),
+                "started": time.time()
+            }
+            for name, conversations, tags in sources:
+                if name in pending:
+                    self.training_progress["base"] += trainer.train(conversations, source=name, tags=tags)
+            if first_run:
+                trainer.finish_first_run()
         except Exception as e:
-            messagebox.showwarning("训练警告", f"训练未完成: {str(e)}")
+            self.root.after(0, messagebox.showwarning, "训练警告", f"训练未完成: {str(e)}")
+
+    def report_training_progress(self, done, total):
+        """在状态栏显示首次训练的进度、速度和预计剩余时间"""
+        progress = self.training_progress
+        finished = progress["base"] + done
+        elapsed = time.time() - progress["started"]
+        rate = finished / elapsed if elapsed > 0 else 0
+        remaining = (progress["total"] - finished) / rate if rate else 0
+        self.root.after(
+            0, self.set_chatbot_status,
+            f"首次训练 {finished}/{progress['total']} 对 · {rate:.0f} 对/秒 · 预计剩余 {remaining:.0f} 秒"
+        )
 
     def start_training_mode(self):
         """进入训练模式"""
@@ -373,6 +2849,9 @@ class EnhancedChatApplication:
 
     def train_from_json_file(self):
         """从JSON文件批量训练，支持多种数据格式"""
+        if self.import_job is not None:
+            self.display_message("系统", "已有训练文件正在导入，请等待完成或取消", "error")
+            return
         file_path = filedialog.askopenfilename(
             title="选择训练文件",
             filetypes=[("JSON文件", "*.json")],
@@ -383,89 +2862,146 @@ class EnhancedChatApplication:
             self.display_message("系统", "已取消文件选择", "system")
             return
             
+        if training_file_format(file_path) is None:
+            self.display_message("系统", "文件为空", "error")
+            return
+            
+        self.start_import_job(file_path)
+
+    def start_import_job(self, file_path):
+        """在后台线程中导入训练文件，聊天窗口下方显示进度和取消按钮，导入期间照常聊天"""
+        self.import_job = {
+            "path": file_path,
+            "size": os.path.getsize(file_path),
+            "bytes": 0,
+            "parsed": 0,
+            "trained": 0,
+            "skipped": 0,
+            "started": time.time(),
+            "cancel": threading.Event(),
+            "recovery": TrainingRecordRecovery(file_path)
+        }
+        self.import_cancel_btn.config(state=tk.NORMAL)
+        self.import_frame.pack(fill=tk.X, pady=(5, 0), before=self.input_frame)
+        self.update_import_panel()
+        threading.Thread(target=self.run_import_job, args=(self.import_job,), daemon=True).start()
+
+    def run_import_job(self, job):
+        """解析并训练导入文件(在后台线程中运行)"""
+        def set_bytes(position):
+            job["bytes"] = position
+        
         try:
-            with open(file_path, "r", encoding="utf-8") as f:
-                content = f.read().strip()
-                
-                if not content:
-                    self.display_message("系统", "文件为空", "error")
-                    return
-                
-                try:
-                    # 尝试解析JSON数组或每行一个JSON对象
-                    if content.startswith("[") and content.endswith("]"):
-                        training_data = json.loads(content)
-                    else:
-                        lines = [line.strip() for line in content.split("\n") if line.strip()]
-                        training_data = [json.loads(line) for line in lines]
-                except json.JSONDecodeError as e:
-                    print(f"JSON解析错误: {e}")
-                    try:
-                        content = content.replace("'", "\"")
-                        content = content.replace("True", "true").replace("False", "false")
-                        content = content.replace(",\n}", "\n}").replace(",\n]", "\n]")
-                        
-                        if content.startswith("[") and content.endswith("]"):
-                            training_data = json.loads(content)
-                        else:
-                            lines = [line.strip() for line in content.split("\n") if line.strip()]
-                            training_data = [json.loads(line) for line in lines]
-                    except json.JSONDecodeError as e2:
-                        print(f"修复JSON失败: {e2}")
-                        self.display_message("系统", "无法解析JSON文件", "error")
+            try:
+                # 逐条流式读取并训练，大型JSON Lines文件在进程池中并行解析，格式错误的记录逐条修复或隔离
+                self.train_from_items(
+                    iter_training_entries(job["path"], progress_callback=set_bytes, recovery=job["recovery"]), job
+                )
+            finally:
+                job["recovery"].close()
+            self.root.after(0, self.finish_import_job, job, None)
+        except Exception as e:
+            self.root.after(0, self.finish_import_job, job, f"训练失败: {str(e)}")
+
+    def update_import_panel(self):
+        """每隔半秒刷新导入进度：已解析、已训练、跳过重复、速度和预计剩余时间"""
+        job = self.import_job
+        if job is None:
+            return
+        elapsed = time.time() - job["started"]
+        rate = job["parsed"] / elapsed if elapsed > 0 else 0
+        fraction = job["bytes"] / job["size"] if job["size"] else 0
+        remaining = f"{elapsed * (1 - fraction) / fraction:.0f} 秒" if fraction > 0 else "--"
+        status = "正在取消..." if job["cancel"].is_set() else f"导入中 {fraction:.0%}"
+        self.import_label.config(
+            text=f"{status} · 已解析 {job['parsed']} 条 · 已训练 {job['trained']} 条 · "
+                 f"跳过重复 {job['skipped']} 条 · {rate:.0f} 条/秒 · 预计剩余 {remaining}"
+        )
+        self.root.after(500, self.update_import_panel)
+
+    def cancel_import_job(self):
+        """取消导入，已训练的部分照常提交和保存"""
+        if self.import_job is not None:
+            self.import_job["cancel"].set()
+            self.import_cancel_btn.config(state=tk.DISABLED)
+
+    def finish_import_job(self, job, error):
+        """导入结束(在界面线程中调用)：保存已训练的数据并显示结果"""
+        self.import_job = None
+        self.import_frame.pack_forget()
+        if job["trained"]:
+            self.save_training_data()
+            self.response_cache.clear()
+        # 聊天引擎在导入期间就绪时，导入的对话仍在待写入列表中
+        if self.chatbot is not None:
+            self.flush_pending_training()
+        summary = job["recovery"].summary()
+        if summary is not None:
+            self.display_message("系统", summary, "error" if job["recovery"].rejected else "system")
+        if error is not None:
+            if job["trained"]:
+                error += f"，已保留此前训练的 {job['trained']} 条数据"
+            self.display_message("系统", error, "error")
+            return
+        summary = f"已从文件训练 {job['trained']} 条数据，跳过 {job['skipped']} 条近似重复"
+        if job["cancel"].is_set():
+            summary = "导入已取消，" + summary
+        self.display_message("系统", summary, "system")
+
+    def train_from_items(self, entries, job=None):
+        """逐条导入规范化后的训练条目：跳过近似重复，更新知识库并流式写入ChatterBot数据库，返回(训练数, 跳过数)
+        
+        指定导入任务时更新其计数并响应取消，数据库按批提交，失败时只撤销本次导入中未提交的部分
+        """
+        added = []
+        skipped_count = 0
+        trainer = None
+        
+        def accepted_conversations():
+            nonlocal skipped_count
+            for trained_item in entries:
+                if job is not None:
+                    if job["cancel"].is_set():
                         return
-                
-            if not isinstance(training_data, list):
-                self.display_message("系统", "JSON文件格式不正确，应为列表格式", "error")
-                return
-                
-            list_trainer = ListTrainer(self.chatbot)
-            trained_count = 0
-            
-            for item in training_data:
-                if not isinstance(item, dict):
+                    job["parsed"] += 1
+                question = trained_item.get("question", trained_item.get("input"))
+                answer = trained_item.get("answer", trained_item.get("target"))
+                with self.knowledge_lock:
+                    duplicate = self.is_near_duplicate(question, answer)
+                    if not duplicate:
+                        self.training_data.append(trained_item)
+                        self.add_qa_item(trained_item)
+                if duplicate:
+                    skipped_count += 1
+                    if job is not None:
+                        job["skipped"] += 1
                     continue
-                    
-                # 标准问答格式
-                if "question" in item and "answer" in item:
-                    question = item.get("question", "")
-                    answers = item.get("answer", [])
-                    if isinstance(answers, str):
-                        answers = [answers]
-                        
-                    for answer in answers:
-                        if question and answer:
-                            try:
-                                list_trainer.train([question, answer])
-                                trained_count += 1
-                                self.training_data.append({
-                                    "question": question,
-                                    "answer": answer
-                                })
-                            except Exception as e:
-                                print(f"训练失败(问题: {question}): {str(e)}")
-                
-                # 新增支持的任务格式
-                elif "input" in item and ("target" in item or "answer" in item):
-                    question = item.get("input", "")
-                    answer = item.get("target", item.get("answer", ""))
-                    if question and answer:
-                        try:
-                            list_trainer.train([question, answer])
-                            trained_count += 1
-                            self.training_data.append({
-                                "input": question,
-                                "target": answer
-                            })
-                        except Exception as e:
-                            print(f"训练失败(问题: {question}): {str(e)}")
-            
-            self.save_training_data()
-            self.build_qa_mapping()
-            self.display_message("系统", f"已从文件训练 {trained_count} 条数据", "system")
-            
-        except Exception as e:
-            self.display_message("系统", f"训练失败: {str(e)}", "error")
+                added.append(trained_item)
+                if job is not None:
+                    job["trained"] += 1
+                yield [question, answer]
+        
+        try:
+            if self.chatbot is None:
+                conversations = list(accepted_conversations())
+                with self.knowledge_lock:
+                    self.pending_training.extend(conversations)
+                trained_count = len(conversations)
+            else:
+                trainer = BulkTrainer(self.chatbot)
+                trained_count = trainer.train(accepted_conversations(), incremental=job is not None)
+        except Exception:
+            # 未提交的批次已由数据库回滚，内存中对应的新增数据也一并撤销；导入期间手动教学的条目不受影响
+            committed = trainer.committed if trainer is not None else 0
+            rolled_back = {id(trained_item) for trained_item in added[committed:]}
+            with self.knowledge_lock:
+                for trained_item in added[committed:]:
+                    self.remove_qa_item(trained_item)
+                self.training_data[:] = [item for item in self.training_data if id(item) not in rolled_back]
+            if job is not None:
+                job["trained"] = committed
+            raise
+        return trained_count, skipped_count
 
     def ask_training_question(self):
         """询问训练问题"""
@@ -479,16 +3015,23 @@ class EnhancedChatApplication:
             self.end_training_mode()
             return
             
-        self.training_data.append({
+        item = {
             "question": question,
             "answer": answer
-        })
-        self.save_training_data()
-        self.build_qa_mapping()
+        }
+        with self.knowledge_lock:
+            self.training_data.append(item)
+            self.add_qa_item(item)
+        self.append_training_items([item])
+        self.response_cache.clear()
         
         try:
-            list_trainer = ListTrainer(self.chatbot)
-            list_trainer.train([question, answer])
+            if self.chatbot is None:
+                with self.knowledge_lock:
+                    self.pending_training.append([question, answer])
+            else:
+                list_trainer = ListTrainer(self.chatbot)
+                list_trainer.train([question, answer])
             self.display_message("系统", f"已学习: Q: {question} A: {answer}", "system")
         except Exception as e:
             self.display_message("系统", f"训练失败: {str(e)}", "error")
@@ -516,6 +3059,13 @@ class EnhancedChatApplication:
             font=("Microsoft YaHei", 16, "bold")
         ).pack(side=tk.LEFT)
         
+        self.status_label = ttk.Label(
+            self.header_frame,
+            text="聊天引擎加载中...",
+            font=("Microsoft YaHei", 9)
+        )
+        self.status_label.pack(side=tk.LEFT, padx=10)
+        
         self.theme_btn = ttk.Button(
             self.header_frame,
             text="🌙" if self.current_theme == "light" else "☀️",
@@ -549,6 +3099,20 @@ class EnhancedChatApplication:
         scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
         self.chat_display.config(yscrollcommand=scrollbar.set)
         
+        # 训练文件导入进度，导入期间才显示
+        self.import_frame = ttk.Frame(self.main_container)
+        self.import_label = ttk.Label(
+            self.import_frame,
+            font=("Microsoft YaHei", 9)
+        )
+        self.import_label.pack(side=tk.LEFT, fill=tk.X, expand=True)
+        self.import_cancel_btn = ttk.Button(
+            self.import_frame,
+            text="取消导入",
+            command=self.cancel_import_job
+        )
+        self.import_cancel_btn.pack(side=tk.RIGHT)
+        
         self.input_frame = ttk.Frame(self.main_container)
         self.input_frame.pack(fill=tk.X, pady=(10, 0))
         
@@ -612,6 +3176,26 @@ class EnhancedChatApplication:
             self.train_from_json_file()
             return
             
+        if message.lower() == "train:benchmark":
+            self.run_matcher_benchmark()
+            return
+            
+        if message.lower() == "train:stats":
+            self.show_performance_stats()
+            return
+            
+        if message.lower() == "train:compact":
+            self.run_db_compaction()
+            return
+            
+        if message.lower() == "train:export":
+            self.export_snapshot()
+            return
+            
+        if message.lower() == "train:import":
+            self.import_snapshot()
+            return
+            
         if self.training_mode:
             return
             
@@ -621,17 +3205,53 @@ class EnhancedChatApplication:
             daemon=True
         ).start()
 
+    def response_tiers(self):
+        """回复流水线的各层：(名称, 处理函数, 超时秒数, 置信度阈值)"""
+        return [
+            ("exact", self.answer_exact, 0.1, 1.0),
+            ("fuzzy", self.answer_fuzzy, 0.5, self.answer_threshold),
+            ("chatterbot", self.answer_chatterbot, 4.0, 0.0)
+        ]
+
+    def answer_exact(self, message, timeout):
+        """回复流水线的精确匹配层"""
+        with self.knowledge_lock:
+            question = self.find_exact_question(message.lower().strip())
+            if question is None:
+                return None
+            return self.qa_mapping[question], 1.0
+
+    def answer_fuzzy(self, message, timeout):
+        """回复流水线的模糊检索层"""
+        with self.knowledge_lock:
+            results, _ = self.retrieve(message, k=1)
+        if not results:
+            return None
+        return results[0][1], results[0][2]
+
+    def answer_chatterbot(self, message, timeout):
+        """回复流水线的ChatterBot层，聊天引擎就绪前跳过"""
+        if self.chatbot is None:
+            return None
+        response = self.chatbot.get_response(message)
+        return str(response), response.confidence
+
     def get_bot_response(self, message):
         """获取机器人响应"""
         try:
-            similar_question = self.find_similar_question(message)
+            cache_key = ResponseCache.make_key(message, "local")
+            response = self.response_cache.get(cache_key)
             
-            if similar_question:
-                response = self.qa_mapping[similar_question]
-                self.root.after(0, self.display_message, "小梓", response, "bot")
-            else:
-                response = str(self.chatbot.get_response(message))
-                self.root.after(0, self.display_message, "小梓", response, "bot")
+            if response is None:
+                # 精确匹配、模糊检索、ChatterBot依次尝试，得分足够高时直接回答
+                response, _, timed_out, error = self.response_pipeline.run(message, self.response_tiers())
+                if response is None:
+                    response = "聊天引擎正在加载中，请稍后再试" if self.chatbot is None else "回复超时，请稍后再试"
+                elif self.chatbot is not None and not timed_out and error is None:
+                    # 聊天引擎就绪前的回答、超时后的回答和有层出错时的回答只是临时结果，不写入缓存
+                    self.response_cache.put(cache_key, response)
+            
+            self.root.after(0, self.display_message, "小梓", response, "bot")
                 
         except Exception as e:
             error_msg = f"生成回复时出错: {str(e)}"